@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from loaders import cachedBeside
+from volume import dequantize
+
+BLOCK = 64
+
+# Values read at once by the block-wise passes, bounding their temporaries
+BLOCK_VALUES = 2**22
+
+AI_POROSITY = 'Porosity from AI percent maps'
+
+
+def iterBlocks(volume, step=BLOCK):
+    """Yield (start, block) over a volume, step slices at a time.
+
+    Only one block is in memory at once, so this also streams lazily
+    loaded volumes.
+    """
+    for start in range(0, len(volume), step):
+        yield start, np.asarray(volume[start:start + step])
+
+
+def blockStep(sliceValues, values=BLOCK_VALUES) -> int:
+    """Slices per block for blocks of at most values values (and at least
+    one slice), sliceValues being the values of one slice of the block.
+    """
+    return max(1, values // max(int(sliceValues), 1))
+
+
+def selectRoi(block, roi=None) -> np.ndarray:
+    """Pixels of every slice in block as a (slices, pixels) array.
+
+    roi is None for whole slices, a (y0, y1, x0, x1) rectangle or a
+    boolean mask of the slice shape.
+    """
+    if roi is None:
+        pixels = block
+    elif isinstance(roi, np.ndarray):
+        pixels = block[:, roi]
+    else:
+        y0, y1, x0, x1 = roi
+        pixels = block[:, y0:y1, x0:x1]
+    return pixels.reshape(len(block), -1)
+
+
+# ------------- Porosity per slice  ---------------------------------------------------
+def slicePorosity(solids, roi=None, step=BLOCK) -> pd.DataFrame:
+    """Porosity statistics of every slice from the solid-fraction stack.
+
+    The porosity of a pixel is 1 - its solid fraction. The slices are
+    processed step at a time, each block in one vectorized pass. A
+    quantized stack is read through its scale.
+    """
+    n = len(solids)
+    mean = np.empty(n)
+    std = np.empty(n)
+    low = np.empty(n)
+    high = np.empty(n)
+
+    for start, block in iterBlocks(solids, step):
+        pores = 1.0 - dequantize(selectRoi(block, roi),
+                                 solids).astype(np.float64)
+        stop = start + len(block)
+        mean[start:stop] = pores.mean(axis=1)
+        std[start:stop] = pores.std(axis=1)
+        low[start:stop] = pores.min(axis=1)
+        high[start:stop] = pores.max(axis=1)
+
+    return pd.DataFrame({
+        "slice": np.arange(n),
+        "porosity": mean,
+        "porosity std": std,
+        "porosity min": low,
+        "porosity max": high,
+    })
+
+
+def SlicePorosity(solids) -> pd.DataFrame:
+    """slicePorosity of whole slices, stored next to the file of a
+    memory-mapped stack, one .npy per column, and rebuilt when it changes.
+    """
+    columns = ["slice", "porosity", "porosity std", "porosity min",
+               "porosity max"]
+    names = [f'c{i}' for i in range(len(columns))]
+
+    def write(paths):
+        table = slicePorosity(solids)
+        for name, column in zip(names, columns):
+            with open(paths[name], 'wb') as f:
+                np.save(f, table[column].to_numpy())
+
+    stored = cachedBeside(solids, '-porosity', {"columns": columns}, names,
+                          write, 0)
+    if stored is None:
+        return slicePorosity(solids)
+    return pd.DataFrame({c: np.asarray(v) for c, v in zip(columns, stored)})
+
+
+def addSliceColumns(df, depthCol, sliceDepths, columns) -> pd.DataFrame:
+    """Outer-join per-slice series onto a depth table, matched on depth.
+
+    columns maps a column name to one value per slice (or per window of
+    slices, with sliceDepths the depth of each window). Depths are rounded
+    to 1e-6 so float noise in either table does not split rows.
+    """
+    slices = pd.DataFrame({depthCol: np.round(sliceDepths, 6), **columns})
+    df = df.assign(**{depthCol: df[depthCol].round(6)})
+    df = df.merge(slices, on=depthCol, how='outer')
+    return df.sort_values(depthCol, kind='stable').reset_index(drop=True)
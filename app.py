@@ -2,60 +2,114 @@
 import vtkmodules.vtkInteractionStyle
 # noinspection PyUnresolvedReferences
 import vtkmodules.vtkRenderingOpenGL2
-from vtkmodules.vtkIOImage import vtkDICOMImageReader
 
 import os
-import numpy as np
-import pandas as pd
+import logging
 
-import plotly.graph_objects as go
-import plotly.express as px
+import numpy as np
 
 import dash
 from dash import dcc
 from dash import html
+from dash import Patch
 import dash_bootstrap_components as dbc
-from dash_slicer import VolumeSlicer
 from dash.dependencies import Input, Output, State
 
-
-def npArrAppend(np_arr, target):
-    if np_arr is None:
-        np_arr = target[np.newaxis, :]
-    else:
-        np_arr = np.append(np_arr, target[np.newaxis, :], axis=0)
-
-    return np_arr
+from analysis import AI_POROSITY
+from figures import (FigureCache, histogramFigure, porosityLineFigure,
+                     surfaceFigure)
+from jobs import CANCELLED, DONE, FAILED, JobQueue
+from metrics import instrument
+from pores import PORE_COLUMNS
+from registry import DatasetRegistry, DatasetSpec, ingestDataset
+from roi import MaskCache, rectPixels, regionStats, shapeGeometry
+from segment import segmentRegion, surfaceMesh
+from slices import CachedSlicer, SliceCache, SlicePrefetcher
+from volume import volumeFile, volumeVersion
 
 
 app = dash.Dash(__name__, update_title=None)
 server = app.server
 
+# Callback latency and response sizes on /metrics, METRICS=0 turns it off
+# and METRICS_LOG=1 also logs every callback as a JSON line
+metrics = None
+if os.environ.get('METRICS', '1') != '0':
+    if os.environ.get('METRICS_LOG') == '1':
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    metrics = instrument(app, logRequests=os.environ.get('METRICS_LOG') == '1')
 
 # ------------- I/O and data massaging ---------------------------------------------------
-# ------------- dicom Image  ---------------------------------------------------
-def DicomImage(inDirname="./assets/RockCT") -> np.array:
-
-    reader = vtkDICOMImageReader()
-    reader.SetDirectoryName(inDirname)
-    reader.Update()
-
-    files = os.listdir(inDirname)
-
-    dcmImage_CT = np.array(
-        reader.GetOutput().GetPointData().GetScalars()).reshape(
-            len(files), reader.GetHeight(), reader.GetWidth())
-
-    return dcmImage_CT
-
+targetCol = [
+    'Depth (cm)', 'Fractional porosity', 'CTG=1095 by Computer with weight',
+    'pix2pix unet 512 train 1095 test 1095',
+    '512_unet512_lsgan_1095_isResetValAboveSoildCt',
+    'pix2pix unet 512 train 970 test 970'
+]
 
-Hu = DicomImage()
+# ------------- Datasets  ---------------------------------------------------
+CORE = 'BH-3_15'
+# Rows of the core's sheet that are logged, CORE_ROWS overrides it
+CORE_ROWS = int(os.environ.get('CORE_ROWS', 495))
+
+registry = DatasetRegistry()
+registry.register(
+    DatasetSpec(CORE,
+                './assets/RockCT',
+                './assets/image_np/',
+                './assets/percent_np/',
+                './assets/porosity.xlsx',
+                'MSCL_BH-3_15m',
+                usecols=targetCol,
+                rows=CORE_ROWS))
+registry.discover('./assets/cores/', usecols=targetCol)
+# The slicers are bound to this core's volumes, so it is never evicted
+registry.pin(CORE)
+core = registry.get(CORE)
+
+# ------------- Slice images  ---------------------------------------------------
+# Encoded slices are shared by all sessions, SLICE_CACHE_DIR also keeps
+# them on disk for other workers and restarts
+slice_cache = SliceCache(diskDir=os.environ.get('SLICE_CACHE_DIR'))
+# The slices next to the one on screen are encoded ahead of the slider
+prefetcher = SlicePrefetcher()
+if metrics is not None:
+    metrics.addValue('slice_cache_hits_total', 'Slice images found in memory.',
+                     lambda: slice_cache.hits, 'counter')
+    metrics.addValue('slice_cache_disk_hits_total',
+                     'Slice images read from disk.',
+                     lambda: slice_cache.diskHits, 'counter')
+    metrics.addValue('slice_cache_misses_total', 'Slice images encoded.',
+                     lambda: slice_cache.misses, 'counter')
+    metrics.addValue('slice_cache_evictions_total',
+                     'Slice images dropped from memory.',
+                     lambda: slice_cache.evictions, 'counter')
+    metrics.addValue('slice_cache_bytes', 'Bytes of slice images in memory.',
+                     lambda: slice_cache.nbytes)
+    metrics.addValue('slice_prefetch_scheduled_total',
+                     'Slice images queued for prefetching.',
+                     lambda: prefetcher.scheduled, 'counter')
+    metrics.addValue('slice_prefetch_cancelled_total',
+                     'Queued slice images dropped before encoding.',
+                     lambda: prefetcher.cancelled, 'counter')
 
-slicer = VolumeSlicer(app, Hu, scene_id="rock")
+# ------------- dicom Image  ---------------------------------------------------
+Hu = core.Hu
+
+slicer = CachedSlicer(app,
+                      Hu,
+                      dataset=CORE,
+                      cache=slice_cache,
+                      prefetcher=prefetcher,
+                      levels=core.Hu_levels,
+                      tiles=core.Hu_tiles,
+                      scene_id="rock",
+                      clim=Hu.clim)
 slicer.graph.figure.update_layout(dragmode="drawrect",
                                   newshape_line_color="cyan",
                                   plot_bgcolor="rgb(0, 0, 0)")
-slicer.graph.config.update(modeBarButtonsToAdd=["drawrect", "eraseshape"])
+slicer.graph.config.update(
+    modeBarButtonsToAdd=["drawrect", "drawclosedpath", "eraseshape"])
 
 slider = dcc.Slider(id="slider0", max=slicer.nslices)
 
@@ -68,57 +122,25 @@ setpos_store = dcc.Store(id={
 
 
 # # ------------- Percent Image  ---------------------------------------------------
-def PercentImage(
-    inDirname_image_np='./assets/image_np/',
-    inDirname_percent_np='./assets/percent_np/'
-) -> (np.array, np.array, np.array, np.array):
-    AIR = -1024
-
-    imgs_np = None
-    solids_np = None
-    CTs_np = None
-    customdatas = None
-
-    files = os.listdir(inDirname_image_np)
-
-    # read img
-    for i in range(len(files)):
-        img = np.load(inDirname_image_np + f'img_{i}.npy')
-        img = img.reshape(img.shape[-2], img.shape[-1])
-
-        ct = ((img + 1) / 2.0) * (3000 - AIR) + AIR
-
-        percent = np.load(inDirname_percent_np + f'percent_{i}.npy').reshape(
-            3, img.shape[-2], img.shape[-1])
-
-        imgs_np = npArrAppend(imgs_np, img)
-        solids_np = npArrAppend(solids_np, percent[0])
-        CTs_np = npArrAppend(CTs_np, ct)
-
-        # customdata
-        customdata = np.array([ct, percent[0], percent[1], percent[2]])
-        customdatas = npArrAppend(customdatas, customdata)
-
-    return imgs_np, solids_np, CTs_np, customdata
-
-
-imgs_np, solids_np, CTs_np, customdata = PercentImage()
-
-slicer_percent = VolumeSlicer(app, solids_np * 1000, scene_id="rock")
+imgs_np, solids_np, CTs_np, customdatas = (core.imgs_np, core.solids_np,
+                                           core.CTs_np, core.customdatas)
+
+# The slicer rescales slices to clim, so the stack is not scaled by 1000 first
+slicer_percent = CachedSlicer(app,
+                              solids_np,
+                              dataset=CORE,
+                              cache=slice_cache,
+                              prefetcher=prefetcher,
+                              levels=core.solids_levels,
+                              tiles=core.solids_tiles,
+                              scene_id="rock",
+                              clim=solids_np.clim)
 slicer_percent.graph.figure.update_layout(dragmode="drawrect",
                                           newshape_line_color="cyan",
                                           plot_bgcolor="rgb(0, 0, 0)")
 
-hovertemplate = "x: %{x} <br> y: %{y} <br> z: %{z} <br> ct: %{customdata[0]:.4f} <br> percent: %{customdata[1]:.4f},  %{customdata[2]:.4f}, %{customdata[3]:.4f}"
-slicer_percent.graph.figure.update_traces(hoverinfo='text',
-                                          customdata=customdata,
-                                          hovertemplate=hovertemplate)
-slicer.graph.figure.update_traces(overwrite=True,hoverinfo="text",
-                                  customdata=customdata,
-                                  hovertemplate=hovertemplate)
-
 slicer_percent.graph.config.update(
-    modeBarButtonsToAdd=["drawrect", "eraseshape"])
+    modeBarButtonsToAdd=["drawrect", "drawclosedpath", "eraseshape"])
 
 slider_percent = dcc.Slider(id="slider1", max=slicer_percent.nslices)
 
@@ -130,22 +152,29 @@ slider_percent = dcc.Slider(id="slider1", max=slicer_percent.nslices)
 # })
 
 # ------------- Porosity  ---------------------------------------------------
-targetCol = [
-    'Depth (cm)', 'Fractional porosity', 'CTG=1095 by Computer with weight',
-    'pix2pix unet 512 train 1095 test 1095',
-    '512_unet512_lsgan_1095_isResetValAboveSoildCt',
-    'pix2pix unet 512 train 970 test 970'
-]
+# Every core's table also has the porosity computed from its percent maps
+targetCol = targetCol + [AI_POROSITY]
+
+depth_index = core.depth_index
+
+line_figures = FigureCache()
+
+
+def porosity_figure(value, xrange=None, name=CORE):
+    dataset = registry.get(name)
+    columns = targetCol[1:] if value == 'All' else [value]
+    return line_figures.get(
+        (name, tuple(columns), xrange, dataset.df_version),
+        lambda: porosityLineFigure(dataset.df, targetCol[0], columns, xrange).
+        update_layout(uirevision=f"{name} {columns}"))
 
-df = pd.read_excel('./assets/porosity.xlsx',
-                   'MSCL_BH-3_15m',
-                   usecols=targetCol).iloc[:495]
 
 axial_card = dbc.Card([
     dbc.CardHeader("Image feeded AI"),
     dbc.CardBody([
         html.Big("BVH3_15"),
-        html.Br(), slicer.graph, slicer.slider, setpos_store, *slicer.stores
+        html.Br(), slicer.graph, slicer.slider,
+        html.Pre(id="hover-rock"), setpos_store, *slicer.stores
     ]),
     dbc.CardFooter([
         html.H6([
@@ -163,7 +192,7 @@ percent_info_card = dbc.Card([
     dbc.CardBody([
         html.Big("BVH3_15"),
         html.Br(), slicer_percent.graph, slicer_percent.slider,
-        *slicer_percent.stores
+        html.Pre(id="hover-percent"), *slicer_percent.stores
     ]),
     dbc.CardFooter([
         html.H6([
@@ -179,20 +208,17 @@ percent_info_card = dbc.Card([
 line_card = dbc.Card([
     dbc.CardHeader("Slices of Porosity"),
     dbc.CardBody([
-        dcc.Dropdown([*targetCol[1:], 'All'],
+        dcc.Dropdown(registry.names(), CORE, id='core-dropdown',
+                     clearable=False),
+        dcc.Dropdown([*targetCol[1:], *PORE_COLUMNS, 'All'],
                      'Fractional porosity',
                      id='line-dropdown'),
+        dcc.Store(id="line-figure",
+                  data=porosity_figure('Fractional porosity')),
+        html.Small(id="core-status"),
+        dcc.Store(id="core-job"),
+        dcc.Interval(id="core-poll", interval=1000, disabled=True),
         dcc.Graph(id="graph-line",
-                  figure=px.line(
-                      df,
-                      x=targetCol[0],
-                      y=targetCol[1],
-                      labels={
-                          "x": "Depth (cm)",
-                          "y": "Porosity"
-                      },
-                      template="plotly_white",
-                  ),
                   config={
                       "modeBarButtonsToAdd": [
                           "drawline",
@@ -221,6 +247,48 @@ line_card = dbc.Card([
     ]),
 ])
 
+# ------------- Histogram  ---------------------------------------------------
+histograms = core.Hu_histograms
+
+histogram_card = dbc.Card([
+    dbc.CardHeader("Histogram of CT values"),
+    dbc.CardBody([
+        dcc.Graph(id="graph-histogram",
+                  figure=histogramFigure(histograms.edges, histograms.slab(),
+                                         "All slices")),
+        dcc.RangeSlider(0,
+                        len(histograms) - 1,
+                        step=1,
+                        value=[0, len(histograms) - 1],
+                        marks=None,
+                        tooltip={"placement": "bottom"},
+                        id="slab-range"),
+        html.Pre(id="roi-stats"),
+    ]),
+    dbc.CardFooter([
+        "Move the range to pick the slab of slices. Draw a rectangle on the"
+        " images to only count that region, widened to whole tiles, and"
+        " to get its mean HU and porosity. A closed path counts exactly the"
+        " pixels inside it.",
+    ]),
+])
+
+# ------------- Segmentation  ---------------------------------------------------
+segmentation_card = dbc.Card([
+    dbc.CardHeader("Segmentation"),
+    dbc.CardBody([
+        dbc.Progress(id="job-progress", value=0, label=""),
+        dbc.Button("Cancel", id="job-cancel", size="sm", className="mt-2"),
+        dcc.Graph(id="graph-surface", figure=surfaceFigure()),
+        dcc.Interval(id="job-poll", interval=1000, disabled=True),
+    ]),
+    dbc.CardFooter([
+        "Draw a shape on the images, then select a range of the histogram:"
+        " the voxels of the slab in that range, inside the shape, are"
+        " segmented in the background and shown on the images and in 3D.",
+    ]),
+])
+
 app.layout = html.Div([
     dbc.Container(
         [
@@ -228,49 +296,346 @@ app.layout = html.Div([
                      dbc.Col(percent_info_card)]),
             dbc.Row([html.Hr()]),
             dbc.Row([dbc.Col(line_card)]),
+            dbc.Row([dbc.Col(histogram_card)]),
+            dbc.Row([dbc.Col(segmentation_card)]),
         ],
         fluid=True,
     ),
     dcc.Store(id="annotations", data={}),
     dcc.Store(id="occlusion-surface", data={}),
+    dcc.Store(id="jobs", data={}),
 ], )
 
 
-@app.callback(Output('graph-line', 'figure'), Input('line-dropdown', 'value'))
-def update_output(value):
-    if value != 'All':
-        fig = px.line(
-            df,
-            x=targetCol[0],
-            y=value,
-            labels={
-                "x": "Depth (cm)",
-                "y": "Porosity"
-            },
-            template="plotly_white",
-        )
-    else:
-        fig = go.Figure()
-        fig.update_layout(xaxis_title="Depth (cm)",
-                          yaxis_title="Porosity",
-                          template="plotly_white")
-
-        for target in targetCol[1:]:
-            fig.add_trace(
-                go.Scatter(x=df[targetCol[0]],
-                           y=df[target],
-                           mode='lines',
-                           name=target))
+# The figures are cached as JSON text, which the browser parses
+app.clientside_callback(
+    """
+function(text) {
+        return text ? JSON.parse(text) : dash_clientside.no_update;
+    }
+""",
+    Output('graph-line', 'figure'),
+    Input('line-figure', 'data'),
+)
+
+
+@app.callback(Output('line-figure', 'data'),
+              Output('core-job', 'data'),
+              Output('core-poll', 'disabled'),
+              Output('core-status', 'children'),
+              Input('line-dropdown', 'value'),
+              Input('graph-line', 'relayoutData'),
+              Input('core-dropdown', 'value'),
+              prevent_initial_call=True)
+def update_output(value, relayoutData, name):
+    no_update = dash.no_update
+    xrange = None
+    # Zooming re-fetches the visible depth range at full resolution
+    if dash.callback_context.triggered_id == 'graph-line':
+        if relayoutData is None:
+            return no_update, no_update, no_update, no_update
+        if 'xaxis.range[0]' in relayoutData:
+            xrange = (relayoutData['xaxis.range[0]'],
+                      relayoutData['xaxis.range[1]'])
+        elif 'xaxis.range' in relayoutData:
+            xrange = tuple(relayoutData['xaxis.range'])
+        elif not relayoutData.get('xaxis.autorange'):
+            return no_update, no_update, no_update, no_update
+    if not registry.isLoaded(name):
+        # A core not in memory may need its caches built, which takes
+        # longer than a request may, so a job loads it first
+        spec = registry.spec(name)
+        job = job_queue.submit(ingestDataset,
+                               key=spec.version(),
+                               spec=vars(spec))
+        return no_update, job, False, f"Loading {name}..."
+    return porosity_figure(value, xrange, name), None, True, ""
+
+
+@app.callback(Output('line-figure', 'data', allow_duplicate=True),
+              Output('core-poll', 'disabled', allow_duplicate=True),
+              Output('core-status', 'children', allow_duplicate=True),
+              Input('core-poll', 'n_intervals'),
+              State('core-job', 'data'),
+              State('line-dropdown', 'value'),
+              State('core-dropdown', 'value'),
+              prevent_initial_call=True)
+def poll_core(n_intervals, job, value, name):
+    if not job:
+        return dash.no_update, True, dash.no_update
+    status = job_queue.status(job)
+    if status["state"] in (FAILED, CANCELLED, None):
+        return (dash.no_update, True,
+                f"Loading {name} failed: {status['message']}")
+    if status["state"] != DONE:
+        return dash.no_update, False, f"Loading {name}: {status['message']}"
+    # Its caches are on disk now, so loading it here is quick
+    return porosity_figure(value, None, name), True, ""
+
+
+# ------------- hover lookup  ---------------------------------------------------
+# The CT and percent values under the cursor are looked up here instead of
+# being embedded in the figures as customdata.
+def hover_text(hoverData, state, nslices):
+    if hoverData is None:
+        return dash.no_update
+    point = hoverData["points"][0]
+    z = nslices // 2 if state is None else state["index"]
+    y, x = int(round(point["y"])), int(round(point["x"]))
+
+    _, _, height, width = customdatas.shape
+    if not (0 <= z < len(customdatas) and 0 <= y < height and 0 <= x < width):
+        return ""
+
+    ct, *percent = customdatas[z, :, y, x]
+    return (f"x: {x}  y: {y}  z: {z}  ct: {ct:.4f}  "
+            f"percent: {percent[0]:.4f}, {percent[1]:.4f}, {percent[2]:.4f}")
+
+
+@app.callback(Output("hover-rock", "children"),
+              Input(slicer.graph.id, "hoverData"),
+              State(slicer.state.id, "data"))
+def hover_rock(hoverData, state):
+    return hover_text(hoverData, state, slicer.nslices)
+
+
+@app.callback(Output("hover-percent", "children"),
+              Input(slicer_percent.graph.id, "hoverData"),
+              State(slicer_percent.state.id, "data"))
+def hover_percent(hoverData, state):
+    return hover_text(hoverData, state, slicer_percent.nslices)
+
+
+@app.callback(Output(setpos_store.id, 'data'),
+              Input('graph-line', 'clickData'),
+              State('core-dropdown', 'value'))
+def Click_changeImage(clickData, name):
+    if clickData != None:
+        # The slicers only show the startup core
+        if name != CORE:
+            return dash.no_update
+        index = depth_index.slice(clickData["points"][0]['x'])
+        # The jump itself makes the prefetcher drop this session's queue
+        return None, None, index
+    return None, int(len(Hu) / 2), int(len(Hu) / 2)
+
+
+@app.callback(Output('graph-line', 'figure', allow_duplicate=True),
+              Input(slicer.state.id, 'data'),
+              State('core-dropdown', 'value'),
+              prevent_initial_call=True)
+def highlight_depth(state, name):
+    if state is None or not state["index_changed"]:
+        return dash.no_update
+    # Only the marker is sent, not the whole figure
+    fig = Patch()
+    if name != CORE:
+        fig['layout']['shapes'] = []
+        return fig
+    fig['layout']['shapes'] = [{
+        "type": "line",
+        "xref": "x",
+        "yref": "paper",
+        "x0": depth_index.depth(state["index"]),
+        "x1": depth_index.depth(state["index"]),
+        "y0": 0,
+        "y1": 1,
+        "line": {
+            "color": "red",
+            "dash": "dot"
+        },
+    }]
     return fig
 
 
-@app.callback(Output(setpos_store.id, 'data'), Input('graph-line',
-                                                     'clickData'))
-def Click_changeImage(clickData):
-    if clickData != None:
-        print(clickData["points"][0]['pointIndex'])
-        return None, None, clickData["points"][0]['pointIndex']
-    return None, int(len(Hu) / 2), int(len(Hu) / 2)
+# ------------- Annotations  ---------------------------------------------------
+# The last shape drawn on either image, in slice pixel coordinates
+@app.callback(Output("annotations", "data"),
+              Input(slicer.graph.id, "relayoutData"),
+              Input(slicer_percent.graph.id, "relayoutData"),
+              State("annotations", "data"))
+def update_annotations(relayout1, relayout2, annotations):
+    if dash.callback_context.triggered_id == slicer.graph.id:
+        relayout = relayout1
+    else:
+        relayout = relayout2
+    if relayout is None:
+        return dash.no_update
+
+    if "shapes" in relayout:
+        if len(relayout["shapes"]) >= 1:
+            annotations["z"] = relayout["shapes"][-1]
+        else:
+            annotations.pop("z", None)
+        return annotations
+
+    # A moved or resized shape only sends the changed keys
+    edits = {
+        key.split(".", 1)[1]: value
+        for key, value in relayout.items() if key.startswith("shapes[")
+    }
+    if not edits or "z" not in annotations:
+        return dash.no_update
+    annotations["z"].update(edits)
+    return annotations
+
+
+# Pixels of drawn closed paths, by shape
+mask_cache = MaskCache()
+
+
+def shape_region(shape, volume):
+    """RegionMask of a drawn closed path on the slices of volume."""
+    return mask_cache.get(shape, volume.shape[1:])
+
+
+@app.callback(Output("graph-histogram", "figure"),
+              Input("annotations", "data"),
+              Input("slab-range", "value"))
+def update_histo(annotations, slab):
+    start, stop = slab[0], slab[1] + 1
+    title = f"Slices {start} to {stop - 1}"
+    shape = (annotations or {}).get("z")
+    if shape is not None and shape.get("type") == "path":
+        region = shape_region(shape, Hu)
+        counts = regionStats(Hu, region, start, stop,
+                             histograms.edges)["histogram"]
+        title += f", {region.count} pixels in the outline"
+    elif shape is not None and shape.get("type") == "rect":
+        rows, cols = histograms.tileCover(*rectPixels(shape))
+        counts = histograms.region(rows, cols, start, stop)
+        tile = histograms.tile
+        _, height, width = Hu.shape
+        title += (f", rows {rows.start * tile} to"
+                  f" {min(rows.stop * tile, height)},"
+                  f" columns {cols.start * tile} to"
+                  f" {min(cols.stop * tile, width)}")
+    else:
+        counts = histograms.slab(start, stop)
+    return histogramFigure(histograms.edges, counts, title)
+
+
+def box_stats(start, stop, box) -> str:
+    """Pixel count, mean HU and porosity of a box over slices [start, stop)."""
+    box = (start, stop) + box
+    count = core.Hu_sums.count(*box)
+    porosity = 1 - core.solids_sums.mean(*box)
+    return (f"{count} px, mean HU {core.Hu_sums.mean(*box):.1f},"
+            f" porosity {porosity:.4f}")
+
+
+def region_stats(start, stop, shape) -> str:
+    """Like box_stats, for the pixels inside a closed path."""
+    hu = regionStats(Hu, shape_region(shape, Hu), start, stop)
+    solids = regionStats(solids_np, shape_region(shape, solids_np), start,
+                         stop)
+    return (f"{hu['count']} px, mean HU {hu['mean']:.1f},"
+            f" porosity {1 - solids['mean']:.4f}")
+
+
+@app.callback(Output("roi-stats", "children"),
+              Input("annotations", "data"),
+              Input("slab-range", "value"),
+              Input(slicer.state.id, "data"))
+def update_roi_stats(annotations, slab, state):
+    shape = (annotations or {}).get("z")
+    if shape is None or shape.get("type") not in ("rect", "path"):
+        return "Draw a rectangle or a closed path to get its statistics."
+    index = state["index"] if state else 0
+    slabs = [(f"Slice {index}", index, index + 1),
+             (f"Slices {slab[0]} to {slab[1]}", slab[0], slab[1] + 1)]
+    if shape["type"] == "rect":
+        lines = [(label, box_stats(start, stop, rectPixels(shape)))
+                 for label, start, stop in slabs]
+    else:
+        lines = [(label, region_stats(start, stop, shape))
+                 for label, start, stop in slabs]
+    return "\n".join(f"{label}: {text}" for label, text in lines)
+
+
+# ------------- Jobs  ---------------------------------------------------
+# Segmentations and surfaces run in a process pool, the callbacks only
+# submit them and poll their progress
+job_queue = JobQueue()
+
+
+def volume_param(volume):
+    """A volume as a job parameter: its file when it has one."""
+    return volumeFile(volume) or np.asarray(volume)
+
+
+@app.callback(Output("jobs", "data", allow_duplicate=True),
+              Output("job-poll", "disabled", allow_duplicate=True),
+              Input("graph-histogram", "selectedData"),
+              State("annotations", "data"),
+              State("slab-range", "value"),
+              prevent_initial_call=True)
+def submit_segmentation(selected, annotations, slab):
+    shape = (annotations or {}).get("z")
+    if (not selected or "range" not in selected or shape is None
+            or shape.get("type") not in ("rect", "path")):
+        return dash.no_update, dash.no_update
+    vmin, vmax = selected["range"]["x"]
+    job = job_queue.submit(segmentRegion,
+                           key=volumeVersion(Hu),
+                           volume=volume_param(Hu),
+                           shape=shapeGeometry(shape),
+                           start=slab[0],
+                           stop=slab[1] + 1,
+                           vmin=vmin,
+                           vmax=vmax)
+    return {"segmentation": job, "surface": None}, False
+
+
+@app.callback(Output("job-progress", "value"),
+              Output("job-progress", "label"),
+              Output(slicer.overlay_data.id, "data"),
+              Output(slicer_percent.overlay_data.id, "data"),
+              Output("graph-surface", "figure"),
+              Output("jobs", "data", allow_duplicate=True),
+              Output("job-poll", "disabled", allow_duplicate=True),
+              Input("job-poll", "n_intervals"),
+              State("jobs", "data"),
+              prevent_initial_call=True)
+def poll_jobs(n_intervals, jobs):
+    no_update = dash.no_update
+    if not jobs.get("segmentation"):
+        return (no_update, ) * 6 + (True, )
+
+    # The segmentation is the first half of the bar, its surface the second
+    stage, half = ("surface", 50) if jobs.get("surface") else ("segmentation",
+                                                               0)
+    status = job_queue.status(jobs[stage])
+    value = half + 50 * status["progress"]
+    label = f'{stage}: {status["message"]}'
+    if status["state"] in (FAILED, CANCELLED, None):
+        return value, label, no_update, no_update, no_update, no_update, True
+    if status["state"] != DONE:
+        return value, label, no_update, no_update, no_update, no_update, False
+
+    if stage == "surface":
+        mesh = job_queue.result(jobs["surface"])
+        return (100, "done", no_update, no_update, surfaceFigure(mesh),
+                no_update, True)
+
+    segmentation = job_queue.result(jobs["segmentation"])
+    mask, box = segmentation["mask"], segmentation["box"]
+    overlay = slicer.boxOverlayData(mask, box)
+    overlay_percent = (slicer_percent.boxOverlayData(mask, box)
+                       if solids_np.shape == Hu.shape else no_update)
+    jobs["surface"] = job_queue.submit(surfaceMesh, mask=mask, box=box)
+    return 50, "surface: queued", overlay, overlay_percent, no_update, jobs, False
+
+
+@app.callback(Output("job-progress", "label", allow_duplicate=True),
+              Input("job-cancel", "n_clicks"),
+              State("jobs", "data"),
+              prevent_initial_call=True)
+def cancel_jobs(n_clicks, jobs):
+    for stage in ("segmentation", "surface"):
+        if jobs.get(stage):
+            job_queue.cancel(jobs[stage])
+    return "cancelling"
 
 
 if __name__ == "__main__":
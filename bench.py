@@ -0,0 +1,329 @@
+"""Benchmarks for startup time, callback latency and payload size.
+
+Synthetic assets of the requested size are generated in a scratch
+directory laid out like ./assets, and the app is imported from there.
+The results are written as JSON so runs can be compared across versions:
+
+    python bench.py --slices 200 --size 512 --rows 5000 --out bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# The sheet and columns app.py reads
+SHEET = 'MSCL_BH-3_15m'
+SHEET_COLUMNS = [
+    'Depth (cm)', 'Fractional porosity', 'CTG=1095 by Computer with weight',
+    'pix2pix unet 512 train 1095 test 1095',
+    '512_unet512_lsgan_1095_isResetValAboveSoildCt',
+    'pix2pix unet 512 train 970 test 970'
+]
+
+
+# ------------- Synthetic assets  ---------------------------------------------------
+def makeDicomSeries(inDirname, nslices, size, rng):
+    os.makedirs(inDirname, exist_ok=True)
+    series = generate_uid()
+    for i in range(nslices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series
+        ds.Modality = 'CT'
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, -float(i)]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.SliceThickness = 1.0
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.PixelData = rng.integers(0, 3000, (size, size),
+                                    dtype=np.uint16).tobytes()
+        ds.save_as(os.path.join(inDirname, f'IM-0001-{i + 1:04d}.dcm'),
+                   write_like_original=False)
+
+
+def makePercentStacks(inDirname_image_np, inDirname_percent_np, nslices, size,
+                      rng):
+    os.makedirs(inDirname_image_np, exist_ok=True)
+    os.makedirs(inDirname_percent_np, exist_ok=True)
+    for i in range(nslices):
+        np.save(os.path.join(inDirname_image_np, f'img_{i}.npy'),
+                rng.integers(0, 3000, (size, size), dtype=np.uint16))
+        percent = rng.random((1, 3, size, size), dtype=np.float32)
+        np.save(os.path.join(inDirname_percent_np, f'percent_{i}.npy'),
+                percent)
+
+
+def makeWorkbook(path, nrows, rng):
+    df = pd.DataFrame({
+        col: rng.random(nrows) * 0.1
+        for col in SHEET_COLUMNS[1:]
+    })
+    df.insert(0, SHEET_COLUMNS[0], np.round(np.arange(nrows) * 0.1, 1))
+    df.to_excel(path, sheet_name=SHEET, index=False)
+
+
+def makeAssets(root, nslices, size, nrows, seed=0):
+    rng = np.random.default_rng(seed)
+    assets = os.path.join(root, 'assets')
+    makeDicomSeries(os.path.join(assets, 'RockCT'), nslices, size, rng)
+    makePercentStacks(os.path.join(assets, 'image_np'),
+                      os.path.join(assets, 'percent_np'), nslices, size, rng)
+    makeWorkbook(os.path.join(assets, 'porosity.xlsx'), nrows, rng)
+
+
+# ------------- Measuring  ---------------------------------------------------
+def timed(fn, repeat=1) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "min_s": min(times),
+        "mean_s": sum(times) / len(times),
+        "max_s": max(times),
+    }
+
+
+def importTime(root) -> float:
+    """Wall time of importing app.py in a fresh interpreter."""
+    env = dict(os.environ, PYTHONPATH=REPO)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-W', 'ignore', '-c', 'import app'],
+                   cwd=root,
+                   env=env,
+                   check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def callbackKey(dashApp, componentId, prop):
+    """Key of the first callback that owns an output, as Dash registered it."""
+    output = f"{_stringId(componentId)}.{prop}"
+    for key in dashApp.callback_map:
+        if output in _keyOutputs(key):
+            return key
+    raise KeyError(f"no callback for {componentId}.{prop}")
+
+
+def _keyOutputs(key) -> list:
+    """The outputs of a callback key, "..a.x...b.y.." for several."""
+    outputs = key[2:-2].split('...') if key.startswith('..') else [key]
+    # Outputs with allow_duplicate are keyed with an @<hash> suffix
+    return [output.split('@')[0] for output in outputs]
+
+
+def _stringId(componentId):
+    if isinstance(componentId, dict):
+        return json.dumps(componentId, sort_keys=True, separators=(',', ':'))
+    return componentId
+
+
+def callCallback(client, dashApp, key, inputs, state=()):
+    """POST one callback request and return (seconds, response bytes)."""
+    callback = dashApp.callback_map[key]
+    inputs = [dict(dep, value=value) for dep, value in zip(callback['inputs'],
+                                                          inputs)]
+    state = [dict(dep, value=value) for dep, value in zip(callback['state'],
+                                                         state)]
+    outputs = []
+    for output in _keyOutputs(key):
+        componentId, prop = output.rsplit('.', 1)
+        if componentId.startswith('{'):
+            componentId = json.loads(componentId)
+        outputs.append({"id": componentId, "property": prop})
+    body = {
+        "output": key,
+        "outputs": outputs if key.startswith('..') else outputs[0],
+        "inputs": inputs,
+        "state": state,
+        "changedPropIds":
+        [f"{_stringId(inputs[0]['id'])}.{inputs[0]['property']}"],
+    }
+    start = time.perf_counter()
+    response = client.post('/_dash-update-component', json=body)
+    elapsed = time.perf_counter() - start
+    if response.status_code not in (200, 204):
+        raise RuntimeError(f"{key} returned {response.status_code}")
+    return elapsed, len(response.data)
+
+
+def benchLoaders(root, repeat) -> dict:
+    import loaders
+
+    assets = os.path.join(root, 'assets')
+    rockCT = os.path.join(assets, 'RockCT')
+    image_np = os.path.join(assets, 'image_np', '')
+    percent_np = os.path.join(assets, 'percent_np', '')
+    workbook = os.path.join(assets, 'porosity.xlsx')
+    cacheDir = os.path.join(root, 'bench-cache')
+
+    report = {
+        "DicomImage_vtk":
+        timed(lambda: loaders.DicomImage(rockCT, cacheDir=None), repeat),
+        "DicomImage_parallel":
+        timed(lambda: loaders.DicomImage(rockCT, None, parallel=True),
+              repeat),
+        "DicomImage_cache_cold":
+        timed(lambda: loaders.DicomImage(rockCT, cacheDir)),
+        "DicomImage_cache_warm":
+        timed(lambda: loaders.DicomImage(rockCT, cacheDir), repeat),
+        "PercentImage":
+        timed(lambda: loaders.PercentImage(image_np, percent_np), repeat),
+        "PercentVolumes_cache_cold":
+        timed(lambda: loaders.PercentVolumes(image_np, percent_np, cacheDir)),
+        "PercentVolumes_cache_warm":
+        timed(lambda: loaders.PercentVolumes(image_np, percent_np, cacheDir),
+              repeat),
+        "read_excel":
+        timed(
+            lambda: pd.read_excel(workbook, SHEET, usecols=SHEET_COLUMNS),
+            repeat),
+        "PorosityTable_cache_cold":
+        timed(lambda: loaders.PorosityTable(workbook, SHEET, SHEET_COLUMNS)),
+        "PorosityTable_cache_warm":
+        timed(lambda: loaders.PorosityTable(workbook, SHEET, SHEET_COLUMNS),
+              repeat),
+    }
+    shutil.rmtree(cacheDir, ignore_errors=True)
+    shutil.rmtree(loaders.porosityCacheDir(workbook), ignore_errors=True)
+    return report
+
+
+def benchApp(root, repeat, rows) -> dict:
+    # The app reads only this many rows of the sheet
+    os.environ['CORE_ROWS'] = str(rows)
+    report = {
+        "import_cold_s": importTime(root),
+        "import_warm_s": importTime(root),
+    }
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+
+    client = app.server.test_client()
+    report["layout_bytes"] = len(client.get('/_dash-layout').data)
+    report["dependencies_bytes"] = len(
+        client.get('/_dash-dependencies').data)
+
+    key = callbackKey(app.app, 'line-figure', 'data')
+    # The layout built one of them at import
+    app.line_figures.clear()
+    figures = {}
+    for value in [*app.targetCol[1:], 'All']:
+        cold, size = callCallback(client, app.app, key,
+                                  [value, None, app.CORE])
+        warm = [
+            callCallback(client, app.app, key, [value, None, app.CORE])[0]
+            for _ in range(repeat)
+        ]
+        figures[value] = {
+            "cold_s": cold,
+            "warm_mean_s": sum(warm) / len(warm),
+            "bytes": size,
+        }
+    report["update_output"] = figures
+
+    key = callbackKey(app.app, app.setpos_store.id, 'data')
+    depths = app.core.df[app.targetCol[0]].to_numpy()
+    rng = np.random.default_rng(0)
+    clicks = [
+        callCallback(client, app.app, key,
+                     [{
+                         "points": [{
+                             "x": float(depth)
+                         }]
+                     }], [app.CORE])[0]
+        for depth in rng.choice(depths, max(repeat, 1))
+    ]
+    report["Click_changeImage"] = {
+        "mean_s": sum(clicks) / len(clicks),
+        "max_s": max(clicks),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--slices', type=int, default=50)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workdir', help="keep the generated assets here")
+    parser.add_argument('--out', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='porosity-bench-')
+    try:
+        if not os.path.isdir(os.path.join(root, 'assets')):
+            makeAssets(root, args.slices, args.size, args.rows)
+
+        report = {
+            "params": {
+                "slices": args.slices,
+                "size": args.size,
+                "rows": args.rows,
+                "repeat": args.repeat,
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "commit": subprocess.run(
+                    ['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=REPO,
+                    capture_output=True,
+                    text=True).stdout.strip(),
+            },
+            "loaders": benchLoaders(root, args.repeat),
+            "app": benchApp(root, args.repeat, args.rows),
+        }
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from analysis import BLOCK_VALUES, blockStep
+from volume import volumeFile
+
+COMPONENT_COLUMNS = ['size', 'z0', 'z1', 'y0', 'y1', 'x0', 'x1', 'cz', 'cy',
+                     'cx']
+
+
+def thresholdMask(block, vmin=None, vmax=None) -> np.ndarray:
+    """Voxels of block in (vmin, vmax], or its non-zero voxels when both
+    are None. Either bound may be left out.
+    """
+    if vmin is None and vmax is None:
+        return np.asarray(block) != 0
+    mask = np.ones(block.shape, bool)
+    if vmin is not None:
+        mask &= block > vmin
+    if vmax is not None:
+        mask &= block <= vmax
+    return mask
+
+
+def _readBlock(source, start, stop) -> np.ndarray:
+    if isinstance(source, str):
+        return np.asarray(np.load(source, mmap_mode='r')[start:stop])
+    return np.asarray(source)
+
+
+def _labelBlock(source, start, stop, vmin, vmax, structure, labelPath):
+    """Label slices [start, stop) on their own.
+
+    Returns the number of labels, the size, bounding box and coordinate
+    sums of each, and the labels of the first and last slice for merging
+    with the neighbouring blocks. With labelPath, the block labels are also
+    written there.
+    """
+    labels, count = ndimage.label(
+        thresholdMask(_readBlock(source, start, stop), vmin, vmax), structure)
+    if labelPath is not None:
+        out = np.load(labelPath, mmap_mode='r+')
+        out[start:stop] = labels
+        out.flush()
+
+    flat = labels.ravel()
+    voxels = np.flatnonzero(flat)
+    ids = flat[voxels]
+    coords = np.stack(np.unravel_index(voxels, labels.shape), axis=1)
+    coords[:, 0] += start
+
+    sizes = np.bincount(ids, minlength=count + 1)[1:]
+    sums = np.stack([
+        np.bincount(ids, coords[:, axis], minlength=count + 1)[1:]
+        for axis in range(3)
+    ], axis=1)
+    mins = np.full((count + 1, 3), np.iinfo(np.int64).max)
+    maxs = np.full((count + 1, 3), -1)
+    np.minimum.at(mins, ids, coords)
+    np.maximum.at(maxs, ids, coords)
+    return {
+        "count": count,
+        "sizes": sizes,
+        "sums": sums,
+        "mins": mins[1:],
+        "maxs": maxs[1:],
+        "first": labels[0].copy(),
+        "last": labels[-1].copy(),
+    }
+
+
+def _relabelBlock(labelPath, start, stop, lookup):
+    """Map the block labels of slices [start, stop) to component labels."""
+    out = np.load(labelPath, mmap_mode='r+')
+    block = np.asarray(out[start:stop])
+    out[start:stop] = lookup[block]
+    out.flush()
+
+
+def _boundaryPairs(last, first, structure) -> np.ndarray:
+    """(a, b) label pairs joined across a block boundary: a on the last
+    slice of one block, b on the first slice of the next, for every
+    in-plane offset the structure connects along depth.
+    """
+    h, w = last.shape
+    pairs = []
+    for dy, dx in np.argwhere(structure[2]) - 1:
+        a = last[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)]
+        b = first[max(0, dy):h + min(0, dy) or None,
+                  max(0, dx):w + min(0, dx) or None]
+        joined = (a != 0) & (b != 0)
+        pairs.append(np.stack([a[joined], b[joined]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def mergeLabels(count, pairs) -> np.ndarray:
+    """Root of every label 0 to count once the labels of each pair are
+    joined, the smallest label of a set being its root.
+
+    A union-find vectorized over the pairs: each round hangs the larger
+    root of every pair under the smaller, then compresses the paths by
+    pointer jumping, until the pairs agree.
+    """
+    parent = np.arange(count + 1)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    while True:
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+        a, b = parent[pairs[:, 0]], parent[pairs[:, 1]]
+        apart = a != b
+        if not apart.any():
+            return parent
+        np.minimum.at(parent, np.maximum(a[apart], b[apart]),
+                      np.minimum(a[apart], b[apart]))
+
+
+def labelComponents(volume,
+                    vmin=None,
+                    vmax=None,
+                    connectivity=1,
+                    labelPath=None,
+                    workers=None,
+                    step=None) -> pd.DataFrame:
+    """Connected components of the voxels of volume in (vmin, vmax], in
+    the dequantized units of a quantized volume. Labels match those of
+    ndimage.label over the whole volume.
+
+    Blocks of step slices are labelled in a process pool and the labels
+    touching across block boundaries merged with mergeLabels, so no
+    temporary spans the whole volume. Returns one row per component,
+    labels from 1 in order of first voxel: size in voxels, bounding box
+    [z0, z1) x [y0, y1) x [x0, x1) and centroid (cz, cy, cx). With
+    labelPath, the int32 label volume is also written there as .npy.
+    """
+    n, h, w = volume.shape
+    scale = getattr(volume, 'scale', None)
+    if scale is not None:
+        # Compare the stored codes, not dequantized copies of them
+        vmin = None if vmin is None else vmin / scale
+        vmax = None if vmax is None else vmax / scale
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    # Each worker labels larger blocks than the other block-wise passes read
+    step = step or blockStep(h * w, 4 * BLOCK_VALUES)
+    starts = list(range(0, n, step))
+    # No more processes than blocks, small volumes take one
+    workers = min(workers or os.cpu_count(), max(len(starts), 1))
+    if labelPath is not None:
+        np.lib.format.open_memmap(labelPath, 'w+', np.int32, (n, h, w)).flush()
+
+    source = volumeFile(volume)
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [
+            pool.submit(_labelBlock, source or np.asarray(volume[s:s + step]),
+                        s, min(s + step, n), vmin, vmax, structure, labelPath)
+            for s in starts
+        ]
+        blocks = [job.result() for job in jobs]
+
+        # Block labels are made global by offsetting each block's
+        offsets = np.cumsum([0] + [block["count"] for block in blocks])
+        for block, offset in zip(blocks, offsets):
+            for face in ("first", "last"):
+                block[face][block[face] != 0] += offset
+        pairs = [
+            _boundaryPairs(upper["last"], lower["first"], structure)
+            for upper, lower in zip(blocks, blocks[1:])
+        ]
+        roots = mergeLabels(offsets[-1],
+                            np.concatenate(pairs or [np.zeros((0, 2))]))
+
+        # Components are numbered 1.. in the order of their roots
+        lookup = np.zeros(offsets[-1] + 1, np.int32)
+        uniqueRoots, lookup[1:] = np.unique(roots[1:], return_inverse=True)
+        lookup[1:] += 1
+        if labelPath is not None:
+            jobs = [
+                pool.submit(_relabelBlock, labelPath, s, min(s + step, n),
+                            _blockLookup(lookup, offset, block["count"]))
+                for s, offset, block in zip(starts, offsets, blocks)
+            ]
+            for job in jobs:
+                job.result()
+
+    return _componentTable(blocks, lookup[1:], len(uniqueRoots))
+
+
+def _blockLookup(lookup, offset, count) -> np.ndarray:
+    """Component label of each block label 0 to count of one block."""
+    return np.concatenate([[0], lookup[offset + 1:offset + count + 1]
+                           ]).astype(np.int32)
+
+
+def _componentTable(blocks, components, count) -> pd.DataFrame:
+    """Sum the per-block statistics of every component."""
+    ids = components - 1
+    sizes = np.concatenate([block["sizes"] for block in blocks])
+    sums = np.concatenate([block["sums"] for block in blocks])
+    mins = np.concatenate([block["mins"] for block in blocks])
+    maxs = np.concatenate([block["maxs"] for block in blocks])
+
+    size = np.bincount(ids, sizes, minlength=count).astype(np.int64)
+    lo = np.full((count, 3), np.iinfo(np.int64).max)
+    hi = np.full((count, 3), -1)
+    np.minimum.at(lo, ids, mins)
+    np.maximum.at(hi, ids, maxs)
+    centroid = np.stack(
+        [np.bincount(ids, sums[:, axis], minlength=count) for axis in range(3)],
+        axis=1) / np.maximum(size, 1)[:, None]
+
+    table = pd.DataFrame(
+        {
+            'size': size,
+            'z0': lo[:, 0],
+            'z1': hi[:, 0] + 1,
+            'y0': lo[:, 1],
+            'y1': hi[:, 1] + 1,
+            'x0': lo[:, 2],
+            'x1': hi[:, 2] + 1,
+            'cz': centroid[:, 0],
+            'cy': centroid[:, 1],
+            'cx': centroid[:, 2],
+        },
+        index=pd.RangeIndex(1, count + 1, name='label'))
+    return table[COMPONENT_COLUMNS]
@@ -0,0 +1,182 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+
+
+def frameVersion(df) -> int:
+    """Content hash of a DataFrame, used to key figures built from it."""
+    return int(pd.util.hash_pandas_object(df).sum())
+
+
+class FigureCache:
+    """Bounded LRU of built figures, stored as encoded JSON text.
+
+    A hit skips the Plotly build, the validation and the encoding of the
+    arrays; the text is sent as is and parsed in the browser.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            fig = self._figures.get(key)
+            if fig is not None:
+                self._figures.move_to_end(key)
+                return fig
+
+        fig = pio.to_json(build(), validate=False)
+
+        with self._lock:
+            self._figures[key] = fig
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)
+        return fig
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+
+
+# ------------- Downsampling  ---------------------------------------------------
+MAX_POINTS = 2000
+
+
+def minMaxIndices(y, maxPoints=MAX_POINTS) -> np.ndarray:
+    """Indices of the samples to draw for a long series.
+
+    The first and last samples are always kept. The rest is split into
+    equal buckets, and each bucket keeps its minimum and maximum, so
+    peaks survive and at most about maxPoints samples are returned.
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= maxPoints:
+        return np.arange(n)
+
+    nbuckets = max(1, (maxPoints - 2) // 2)
+    size = -(-(n - 2) // nbuckets)
+    inner = np.full(nbuckets * size, np.nan)
+    inner[:n - 2] = y[1:-1]
+    inner = inner.reshape(nbuckets, size)
+
+    # NaN samples never win, buckets of only NaN fall back to their start
+    lows = np.where(np.isnan(inner), np.inf, inner).argmin(axis=1)
+    highs = np.where(np.isnan(inner), -np.inf, inner).argmax(axis=1)
+    offsets = np.arange(nbuckets) * size + 1
+
+    keep = np.concatenate(([0, n - 1], offsets + lows, offsets + highs))
+    return np.unique(np.clip(keep, 0, n - 1))
+
+
+def visibleRows(depth, xrange) -> slice:
+    """Rows of a depth-sorted column inside xrange, plus one on either side."""
+    if xrange is None:
+        return slice(None)
+    lo, hi = sorted(xrange)
+    start = max(int(np.searchsorted(depth, lo, side='left')) - 1, 0)
+    stop = int(np.searchsorted(depth, hi, side='right')) + 1
+    return slice(start, stop)
+
+
+# ------------- Porosity line chart  ---------------------------------------------------
+def porosityLineFigure(df, x, columns, xrange=None,
+                       maxPoints=MAX_POINTS) -> go.Figure:
+    """Line chart of one column, or of several with a legend, drawn with WebGL.
+
+    Only rows inside xrange are drawn, downsampled to about maxPoints per
+    trace.
+    """
+    rows = visibleRows(df[x].to_numpy(), xrange)
+    depth = df[x].to_numpy()[rows]
+
+    fig = go.Figure()
+    fig.update_layout(xaxis_title=x if len(columns) == 1 else "Depth (cm)",
+                      yaxis_title=columns[0]
+                      if len(columns) == 1 else "Porosity",
+                      template="plotly_white",
+                      showlegend=len(columns) > 1,
+                      uirevision=str(columns))
+
+    for target in columns:
+        y = df[target].to_numpy(dtype=float)[rows]
+        # Series sampled at other depths (e.g. per slice) are NaN elsewhere
+        valid = ~np.isnan(y)
+        xs, ys = depth[valid], y[valid]
+        keep = minMaxIndices(ys, maxPoints)
+        fig.add_trace(
+            go.Scattergl(x=xs[keep], y=ys[keep], mode='lines', name=target))
+    return fig
+
+
+# ------------- Histogram  ---------------------------------------------------
+def histogramFigure(edges, counts, title=None) -> go.Figure:
+    """Bar chart of binned counts, one bar per bin. Dragging selects a
+    range of values.
+    """
+    edges = np.asarray(edges)
+    fig = go.Figure(
+        go.Bar(x=(edges[:-1] + edges[1:]) / 2,
+               y=counts,
+               width=np.diff(edges),
+               marker_line_width=0))
+    fig.update_layout(xaxis_title="intensity",
+                      yaxis_title="count",
+                      title=title,
+                      template="plotly_white",
+                      bargap=0,
+                      dragmode="select")
+    return fig
+
+
+def surfaceFigure(mesh=None) -> go.Figure:
+    """3D view of a triangle mesh, given as Mesh3d x, y, z, i, j, k."""
+    fig = go.Figure(go.Mesh3d(**(mesh or {}), color="red", opacity=0.8))
+    fig.update_layout(scene_aspectmode="data",
+                      margin=dict(l=0, r=0, t=0, b=0),
+                      template="plotly_white")
+    return fig
+
+
+# ------------- Depth <-> slice  ---------------------------------------------------
+class DepthIndex:
+    """Depth of every slice, sorted once so chart depths resolve to the
+    nearest slice with a binary search.
+    """
+
+    def __init__(self, sliceDepths):
+        self.depths = np.asarray(sliceDepths, dtype=float)
+        self._order = np.argsort(self.depths, kind='stable')
+        self._sorted = self.depths[self._order]
+
+    @classmethod
+    def fromPositions(cls, positions, depth0=0.0, mmPerUnit=10.0):
+        """Slice depths from DICOM positions (mm), with the first slice at
+        depth0 and depths in cm by default.
+        """
+        positions = np.asarray(positions, dtype=float)
+        if np.isnan(positions).any():
+            # Without position tags, assume 1 mm between slices
+            positions = np.arange(len(positions), dtype=float)
+        return cls(depth0 + np.abs(positions - positions[0]) / mmPerUnit)
+
+    def __len__(self):
+        return len(self.depths)
+
+    def slice(self, depth) -> int:
+        """Index of the slice nearest to depth."""
+        i = int(np.searchsorted(self._sorted, depth))
+        # Pick the closer of the two neighbouring slices
+        if i == len(self._sorted) or (i > 0 and depth - self._sorted[i - 1] <=
+                                      self._sorted[i] - depth):
+            i -= 1
+        return int(self._order[i])
+
+    def depth(self, index) -> float:
+        return float(self.depths[index])
@@ -0,0 +1,167 @@
+import numpy as np
+
+from analysis import blockStep, iterBlocks
+from loaders import cachedBeside
+from volume import dequantize
+
+HIST_BINS = 256
+
+# Side of the tiles histograms are also kept for, in pixels
+HIST_TILE = 128
+
+
+def binIndices(block, edges) -> np.ndarray:
+    """Bin of every value of block for bins of equal width between edges[0]
+    and edges[-1]; values outside fall in the first or last bin.
+    """
+    bins = len(edges) - 1
+    lo, hi = float(edges[0]), float(edges[-1])
+    scale = bins / (hi - lo) if hi > lo else 0.0
+    idx = ((np.asarray(block, dtype=np.float64) - lo) * scale).astype(np.int64)
+    return np.clip(idx, 0, bins - 1)
+
+
+def blockHistograms(block, edges, tile=None) -> (np.ndarray, np.ndarray):
+    """Histograms of every slice of block, and of every tile x tile tile
+    of every slice when tile is given (edge tiles are cut short).
+    """
+    bins = len(edges) - 1
+    n, h, w = block.shape
+    idx = binIndices(block, edges)
+    offsets = (np.arange(n) * bins)[:, None, None]
+    slices = np.bincount((idx + offsets).ravel(),
+                         minlength=n * bins).reshape(n, bins)
+    if tile is None:
+        return slices, None
+
+    rows, cols = -(-h // tile), -(-w // tile)
+    row = (np.arange(h) // tile)[:, None]
+    col = (np.arange(w) // tile)[None, :]
+    cell = (np.arange(n)[:, None, None] * rows + row) * cols + col
+    tiles = np.bincount((idx + cell * bins).ravel(),
+                        minlength=n * rows * cols * bins)
+    return slices, tiles.reshape(n, rows, cols, bins)
+
+
+class HistogramIndex:
+    """Fixed-bin histograms of every slice (and of every tile of every
+    slice), summed along depth.
+
+    Row i of a cumulative table is the sum of slices 0 to i - 1, so the
+    histogram of a slab of slices is the difference of two rows, whatever
+    the size of the slab.
+    """
+
+    def __init__(self, edges, slices, tiles=None, tile=None):
+        self.edges = np.asarray(edges)
+        self.slices = slices
+        self.tiles = tiles
+        self.tile = tile
+
+    @property
+    def bins(self) -> int:
+        return len(self.edges) - 1
+
+    def __len__(self):
+        return len(self.slices) - 1
+
+    def _slab(self, start, stop) -> (int, int):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return start, max(start, stop)
+
+    def slab(self, start=None, stop=None) -> np.ndarray:
+        """Counts of the slices start to stop - 1."""
+        start, stop = self._slab(start, stop)
+        return np.asarray(self.slices[stop]) - np.asarray(self.slices[start])
+
+    def tileCover(self, y0, y1, x0, x1) -> (slice, slice):
+        """Rows and columns of the tiles covering pixels [y0, y1) x [x0, x1),
+        empty when the pixels are outside the slice.
+        """
+        if self.tiles is None:
+            raise ValueError("This index has no tile histograms.")
+        rows, cols = self.tiles.shape[1:3]
+
+        def cover(start, stop, count):
+            start = min(max(int(start) // self.tile, 0), count)
+            stop = min(max(-(-int(stop) // self.tile), start), count)
+            return slice(start, stop)
+
+        return cover(y0, y1, rows), cover(x0, x1, cols)
+
+    def region(self, rows, cols, start=None, stop=None) -> np.ndarray:
+        """Counts of the tiles rows x cols, over the slices start to stop - 1."""
+        if self.tiles is None:
+            raise ValueError("This index has no tile histograms.")
+        start, stop = self._slab(start, stop)
+        counts = (np.asarray(self.tiles[stop, rows, cols]) -
+                  np.asarray(self.tiles[start, rows, cols]))
+        return counts.reshape(-1, self.bins).sum(axis=0)
+
+
+def _addCumulative(out, start, histograms):
+    """Write the running sums of the histograms of slices start onwards
+    into rows start + 1 onwards of a cumulative table.
+    """
+    sums = np.cumsum(histograms, axis=0, dtype=np.int64)
+    sums += out[start]
+    out[start + 1:start + 1 + len(sums)] = sums
+
+
+def Histograms(volume,
+               bins=HIST_BINS,
+               valueRange=None,
+               tile=HIST_TILE) -> HistogramIndex:
+    """HistogramIndex of a volume, with bins over valueRange (by default
+    its clim, in dequantized units).
+
+    The index of a memory-mapped volume is stored next to its file and
+    rebuilt when the file changes. Its running sums are written into the
+    stored tables a block of slices at a time, so building it holds one
+    block's histograms in memory, not the whole index.
+    """
+    if valueRange is None:
+        lo, hi = volume.clim if hasattr(volume, 'clim') else (volume.min(),
+                                                             volume.max())
+        valueRange = (float(dequantize(np.float64(lo), volume)),
+                      float(dequantize(np.float64(hi), volume)))
+    edges = np.linspace(valueRange[0], valueRange[1], bins + 1)
+    n, h, w = volume.shape
+    shapes = {"slices": (n + 1, bins)}
+    if tile is not None:
+        shapes["tiles"] = (n + 1, -(-h // tile), -(-w // tile), bins)
+
+    def build(tables):
+        """Fill the cumulative tables a block of slices at a time."""
+        for table in tables.values():
+            table[0] = 0
+        for start, block in iterBlocks(volume, blockStep(h * w)):
+            s, t = blockHistograms(dequantize(block, volume), edges, tile)
+            _addCumulative(tables["slices"], start, s)
+            if tile is not None:
+                _addCumulative(tables["tiles"], start, t)
+
+    names = ['edges', *shapes]
+    manifest = {"bins": bins, "range": list(valueRange), "tile": tile}
+
+    def write(paths):
+        with open(paths['edges'], 'wb') as f:
+            np.save(f, edges)
+        tables = {
+            name: np.lib.format.open_memmap(paths[name], 'w+', np.int64,
+                                            shape)
+            for name, shape in shapes.items()
+        }
+        build(tables)
+        for table in tables.values():
+            table.flush()
+
+    tables = cachedBeside(volume, '-histograms', manifest, names, write, 0)
+    if tables is None:
+        tables = {name: np.empty(shape, np.int64)
+                  for name, shape in shapes.items()}
+        build(tables)
+        return HistogramIndex(edges, tables["slices"], tables.get("tiles"),
+                              tile)
+    edges, slices, *tiles = tables
+    return HistogramIndex(edges, slices, tiles[0] if tiles else None, tile)
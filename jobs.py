@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import pickle
+import socket
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from loaders import CACHE_DIR
+from volume import volumeVersion
+
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(CACHE_DIR, 'jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# Seconds between heartbeats of the process that queued a job, and without
+# one after which a queued or running job is taken for orphaned
+JOB_HEARTBEAT = 5
+JOB_STALE = 30
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = ('pending', 'running', 'done',
+                                             'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """Raised inside a job by its progress callback once it is cancelled."""
+
+
+def _keyDefault(value):
+    if isinstance(value, np.ndarray):
+        return volumeVersion(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot key a job on {type(value).__name__}")
+
+
+def _pidAlive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _writeJson(path, data):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmpPath, path)
+
+
+class _Progress:
+    """The progress callback handed to a job: progress(fraction, message)
+    records how far the job is and raises JobCancelled once it is cancelled.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.owner = {"pid": os.getpid(), "host": socket.gethostname()}
+
+    def __call__(self, fraction, message=''):
+        if os.path.exists(self.paths['cancel']):
+            raise JobCancelled()
+        _writeJson(self.paths['status'], {
+            "state": RUNNING,
+            "progress": float(fraction),
+            "message": message,
+            "heartbeat": time.time(),
+            **self.owner,
+        })
+
+
+def _runJob(func, params, paths):
+    """Run a job in a pool process and store its result or its error."""
+    progress = _Progress(paths)
+    try:
+        progress(0.0, 'started')
+        result = func(progress, **params)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(paths['result']),
+                                       suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, paths['result'])
+        status = {"state": DONE, "progress": 1.0, "message": 'done'}
+    except JobCancelled:
+        status = {"state": CANCELLED, "progress": 0.0, "message": 'cancelled'}
+    except Exception as e:
+        status = {"state": FAILED, "progress": 0.0, "message": repr(e)}
+    _writeJson(paths['status'], status)
+
+
+class JobQueue:
+    """Functions run in a local process pool, their state and results kept
+    in jobDir.
+
+    A job id is a hash of the function and its parameters (arrays by
+    content), so submitting a job that already ran returns the id of its
+    stored result. State lives on disk only, so every process of the app
+    can poll or cancel any job. A job is called as func(progress,
+    **params) and should call progress(fraction, message) now and then.
+
+    The status of a queued job names the process that queued it, that of
+    a running job the pool process running it; the queueing process also
+    touches the job's heartbeat file every JOB_HEARTBEAT seconds. A job
+    whose process is gone, or whose last heartbeat or progress is older
+    than JOB_STALE, is reported failed and runs again when submitted.
+    """
+
+    def __init__(self, jobDir=JOB_DIR, workers=JOB_WORKERS):
+        self.jobDir = jobDir
+        self.workers = workers
+        self._pool = None
+        self._futures = {}
+        # Reentrant, a future that is already done runs its callback at once
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._owner = {"pid": os.getpid(), "host": socket.gethostname()}
+        os.makedirs(jobDir, exist_ok=True)
+
+    def _paths(self, jobId) -> dict:
+        base = os.path.join(self.jobDir, jobId)
+        return {
+            "status": base + '.json',
+            "result": base + '.pkl',
+            "cancel": base + '.cancel',
+            "heartbeat": base + '.alive',
+        }
+
+    def jobId(self, func, params, key=None) -> str:
+        text = json.dumps([func.__module__, func.__qualname__, params, key],
+                          sort_keys=True,
+                          default=_keyDefault)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def submit(self, func, key=None, **params) -> str:
+        """Start func(progress, **params) unless it already ran or runs.
+
+        key is hashed into the job id along with the parameters, e.g. the
+        version of a volume passed by file name.
+        """
+        jobId = self.jobId(func, params, key)
+        paths = self._paths(jobId)
+        if self.status(jobId)["state"] in (PENDING, RUNNING, DONE):
+            return jobId
+
+        with self._lock:
+            if self._pool is None:
+                # Started on first use, so it is not forked by gunicorn
+                self._pool = ProcessPoolExecutor(self.workers)
+                self._stop.clear()
+                threading.Thread(target=self._beat,
+                                 name='job-heartbeat',
+                                 daemon=True).start()
+            if os.path.exists(paths['cancel']):
+                os.remove(paths['cancel'])
+            _writeJson(paths['status'], {
+                "state": PENDING,
+                "progress": 0.0,
+                "message": 'queued',
+                "heartbeat": time.time(),
+                **self._owner,
+            })
+            future = self._pool.submit(_runJob, func, params, paths)
+            self._futures[jobId] = future
+            future.add_done_callback(lambda f: self._forget(jobId, f))
+        return jobId
+
+    def _forget(self, jobId, future):
+        with self._lock:
+            self._futures.pop(jobId, None)
+            if not future.cancelled() and isinstance(future.exception(),
+                                                     BrokenProcessPool):
+                self._pool = None
+        if not future.cancelled() and future.exception() is not None:
+            # The pool process died before the job could record it
+            _writeJson(self._paths(jobId)['status'], {
+                "state": FAILED,
+                "progress": 0.0,
+                "message": repr(future.exception()),
+            })
+
+    def _beat(self):
+        """Touch the heartbeat file of every job this process runs."""
+        while not self._stop.wait(JOB_HEARTBEAT):
+            with self._lock:
+                jobIds = list(self._futures)
+            for jobId in jobIds:
+                path = self._paths(jobId)['heartbeat']
+                with open(path, 'a'):
+                    os.utime(path)
+
+    def _orphaned(self, jobId, status) -> bool:
+        """Whether a queued or running job has lost its process."""
+        with self._lock:
+            if jobId in self._futures:
+                return False
+        if (status.get("host") == self._owner["host"]
+                and not _pidAlive(status.get("pid", 0))):
+            return True
+        beats = [status.get("heartbeat", 0)]
+        try:
+            beats.append(os.path.getmtime(self._paths(jobId)['heartbeat']))
+        except OSError:
+            pass
+        return time.time() - max(beats) > JOB_STALE
+
+    def _readStatus(self, jobId) -> dict:
+        try:
+            with open(self._paths(jobId)['status']) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"state": None, "progress": 0.0, "message": ''}
+
+    def status(self, jobId) -> dict:
+        """state, progress (0 to 1) and message of a job."""
+        status = self._readStatus(jobId)
+        if status["state"] in (PENDING, RUNNING) and self._orphaned(
+                jobId, status):
+            status = {
+                "state": FAILED,
+                "progress": 0.0,
+                "message": 'the process running it is gone',
+            }
+            _writeJson(self._paths(jobId)['status'], status)
+        return status
+
+    def result(self, jobId):
+        """Result of a done job."""
+        with open(self._paths(jobId)['result'], 'rb') as f:
+            return pickle.load(f)
+
+    def cancel(self, jobId):
+        """Drop a queued job, or stop a running one at its next progress.
+        An orphaned job is marked cancelled at once.
+        """
+        paths = self._paths(jobId)
+        status = self._readStatus(jobId)
+        if status["state"] not in (PENDING, RUNNING):
+            return
+        open(paths['cancel'], 'w').close()
+        with self._lock:
+            future = self._futures.get(jobId)
+        if (future is not None
+                and future.cancel()) or self._orphaned(jobId, status):
+            _writeJson(paths['status'], {
+                "state": CANCELLED,
+                "progress": 0.0,
+                "message": 'cancelled',
+            })
+
+    def shutdown(self):
+        self._stop.set()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
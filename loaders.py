@@ -0,0 +1,638 @@
+from vtkmodules.vtkIOImage import vtkDICOMImageReader
+
+import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pydicom
+
+from volume import (HOT_SLICES, DerivedVolume, LazyVolume, dequantize,
+                    volumeFile, volumeRange, volumeVersion)
+
+AIR = -1024
+
+CACHE_DIR = './cache/'
+
+
+# ------------- volume cache  ---------------------------------------------------
+def seriesManifest(inDirname) -> dict:
+    """File list, sizes and mtimes of a series directory, used as cache key."""
+    files = []
+    for name in sorted(os.listdir(inDirname)):
+        st = os.stat(os.path.join(inDirname, name))
+        files.append([name, st.st_size, st.st_mtime_ns])
+    return {"series": os.path.abspath(inDirname), "files": files}
+
+
+def cacheEntryDir(inDirname, cacheDir=CACHE_DIR) -> str:
+    series = os.path.abspath(inDirname)
+    digest = hashlib.sha1(series.encode()).hexdigest()[:12]
+    return os.path.join(cacheDir, f'{os.path.basename(series)}-{digest}')
+
+
+def _writeAtomic(path, write):
+    tmp = path + '.tmp'
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _saveNpy(path, arr):
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+
+def _saveJson(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def loadCachedVolumes(entryDir, manifest, names=('volume', ),
+                      maxSlices=HOT_SLICES):
+    """LazyVolumes of a cache entry if its manifest still matches, else None."""
+    try:
+        with open(os.path.join(entryDir, 'manifest.json')) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(cached.get(k) != v for k, v in manifest.items()):
+        return None
+    try:
+        return [
+            LazyVolume(os.path.join(entryDir, name + '.npy'), maxSlices,
+                       cached["arrays"][name]["clim"],
+                       cached["arrays"][name].get("scale")) for name in names
+        ]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def storeCachedVolumes(entryDir,
+                       manifest,
+                       names,
+                       write,
+                       maxSlices=HOT_SLICES,
+                       scales=None):
+    """Write volumes to the cache and return them as LazyVolumes.
+
+    write(paths) gets the .npy path of every name and fills the files,
+    either by saving in-memory arrays or by streaming slices into them.
+    scales gives the code step of quantized volumes by name.
+    """
+    scales = scales or {}
+    os.makedirs(entryDir, exist_ok=True)
+    manifestPath = os.path.join(entryDir, 'manifest.json')
+    # Drop the old manifest first so a half-written entry never validates
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+    # and arrays of an older layout of the entry
+    for stale in os.listdir(entryDir):
+        if stale.endswith('.npy') and stale[:-4] not in names:
+            os.remove(os.path.join(entryDir, stale))
+
+    paths = {name: os.path.join(entryDir, name + '.npy') for name in names}
+    write({name: path + '.tmp' for name, path in paths.items()})
+
+    arrays = {}
+    for name, path in paths.items():
+        os.replace(path + '.tmp', path)
+        volume = np.load(path, mmap_mode='r')
+        arrays[name] = {
+            "shape": list(volume.shape),
+            "dtype": str(volume.dtype),
+            "clim": volumeRange(volume),
+        }
+        if name in scales:
+            arrays[name]["scale"] = scales[name]
+
+    manifest = dict(manifest, arrays=arrays)
+    _writeAtomic(manifestPath, lambda path: _saveJson(path, manifest))
+
+    return [
+        LazyVolume(paths[name], maxSlices, arrays[name]["clim"],
+                   arrays[name].get("scale")) for name in names
+    ]
+
+
+def cachedBeside(volume,
+                 suffix,
+                 manifest,
+                 names,
+                 write,
+                 maxSlices=HOT_SLICES) -> list:
+    """LazyVolumes derived from a memory-mapped volume, kept in the entry
+    next to its file named after it with suffix, e.g. "-pyramid".
+
+    The entry is filled by write(paths), see storeCachedVolumes, when it
+    is missing or its manifest no longer matches, the volume's version
+    included. None for a volume without a file of its own, whose derived
+    data is to be computed in memory.
+    """
+    source = volumeFile(volume)
+    if source is None:
+        return None
+    entryDir = os.path.splitext(source)[0] + suffix
+    manifest = dict(manifest, source=volumeVersion(volume))
+    volumes = loadCachedVolumes(entryDir, manifest, names, maxSlices)
+    if volumes is None:
+        volumes = storeCachedVolumes(entryDir, manifest, names, write,
+                                     maxSlices)
+    return volumes
+
+
+# ------------- dicom Image  ---------------------------------------------------
+def decodeDicomSeries(inDirname="./assets/RockCT") -> np.array:
+    reader = vtkDICOMImageReader()
+    reader.SetDirectoryName(inDirname)
+    reader.Update()
+
+    files = os.listdir(inDirname)
+
+    dcmImage_CT = np.array(
+        reader.GetOutput().GetPointData().GetScalars()).reshape(
+            len(files), reader.GetHeight(), reader.GetWidth())
+
+    return dcmImage_CT
+
+
+def isDicomFile(path) -> bool:
+    """Check for the DICM magic that follows the 128-byte preamble."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+def _slicePosition(header):
+    """Distance of a slice along its normal, NaN without position tags."""
+    path, instance, position, orientation = header
+    if position is None or orientation is None:
+        return np.nan
+    normal = np.cross(orientation[:3], orientation[3:])
+    return float(np.dot(normal, position))
+
+
+def _dicomSortKey(header):
+    path, instance, position, orientation = header
+    # Descending along the slice normal, like vtkDICOMImageReader
+    location = _slicePosition(header)
+    location = 0.0 if np.isnan(location) else -location
+    return (instance is None, instance or 0, location, os.path.basename(path))
+
+
+def _readDicomHeader(path):
+    ds = pydicom.dcmread(path, stop_before_pixels=True)
+    instance = ds.get('InstanceNumber')
+    position = ds.get('ImagePositionPatient')
+    orientation = ds.get('ImageOrientationPatient')
+    return (path, None if instance is None else int(instance),
+            None if position is None else [float(v) for v in position],
+            None if orientation is None else [float(v) for v in orientation])
+
+
+def _decodeDicomSlices(outPath, start, paths):
+    out = np.load(outPath, mmap_mode='r+')
+    for i, path in enumerate(paths, start):
+        ds = pydicom.dcmread(path)
+        img = ds.pixel_array.astype(np.float32)
+        img = img * float(ds.get('RescaleSlope', 1)) + float(
+            ds.get('RescaleIntercept', 0))
+        # Rows bottom-up, as vtkDICOMImageReader returns them
+        out[i] = img[::-1]
+    out.flush()
+
+
+def _dicomPaths(inDirname):
+    paths = [
+        os.path.join(inDirname, name) for name in sorted(os.listdir(inDirname))
+    ]
+    paths = [path for path in paths if isDicomFile(path)]
+    if not paths:
+        raise ValueError(f"No DICOM files found in {inDirname}")
+    return paths
+
+
+def _sortedDicomHeaders(paths, pool, chunksize):
+    headers = pool.map(_readDicomHeader, paths, chunksize=chunksize)
+    return sorted(headers, key=_dicomSortKey)
+
+
+def decodeDicomSeriesParallel(inDirname="./assets/RockCT",
+                              outPath=None,
+                              workers=None) -> np.array:
+    """Decode a series with a process pool into one int16 volume.
+
+    Non-DICOM files are skipped and slices are ordered by InstanceNumber,
+    then by ImagePositionPatient. The slices are written straight into the
+    .npy file at outPath; without outPath a temporary file is used and the
+    volume is returned in memory.
+    """
+    paths = _dicomPaths(inDirname)
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(paths) // (workers * 4))
+
+    with ProcessPoolExecutor(workers) as pool:
+        headers = _sortedDicomHeaders(paths, pool, chunksize)
+        paths = [header[0] for header in headers]
+
+        first = pydicom.dcmread(paths[0], stop_before_pixels=True)
+        shape = (len(paths), int(first.Rows), int(first.Columns))
+
+        if outPath is None:
+            fd, tmpPath = tempfile.mkstemp(suffix='.npy')
+            os.close(fd)
+        else:
+            tmpPath = outPath
+        np.lib.format.open_memmap(tmpPath, 'w+', np.int16, shape).flush()
+
+        jobs = [
+            pool.submit(_decodeDicomSlices, tmpPath, start,
+                        paths[start:start + chunksize])
+            for start in range(0, len(paths), chunksize)
+        ]
+        for job in jobs:
+            job.result()
+
+    if outPath is not None:
+        return np.load(outPath, mmap_mode='r')
+
+    dcmImage_CT = np.load(tmpPath)
+    os.remove(tmpPath)
+    return dcmImage_CT
+
+
+def DicomImage(inDirname="./assets/RockCT",
+               cacheDir=CACHE_DIR,
+               parallel=False,
+               maxSlices=HOT_SLICES) -> np.array:
+    """Decoded series volume, read lazily from cacheDir when up to date.
+
+    Pass cacheDir=None to always decode the series into memory, and
+    parallel=True to decode with decodeDicomSeriesParallel instead of
+    vtkDICOMImageReader.
+    """
+    if cacheDir is None:
+        if parallel:
+            return decodeDicomSeriesParallel(inDirname)
+        return decodeDicomSeries(inDirname)
+
+    manifest = seriesManifest(inDirname)
+    manifest["decoder"] = 'parallel' if parallel else 'vtk'
+    entryDir = cacheEntryDir(inDirname, cacheDir)
+
+    volumes = loadCachedVolumes(entryDir, manifest, maxSlices=maxSlices)
+    if volumes is None:
+        if parallel:
+            write = lambda paths: decodeDicomSeriesParallel(
+                inDirname, paths['volume'])
+        else:
+            write = lambda paths: _saveNpy(paths['volume'],
+                                           decodeDicomSeries(inDirname))
+        volumes = storeCachedVolumes(entryDir, manifest, ['volume'], write,
+                                     maxSlices)
+
+    return volumes[0]
+
+
+def DicomSlicePositions(inDirname="./assets/RockCT",
+                        cacheDir=CACHE_DIR,
+                        workers=None) -> np.array:
+    """Position of every slice along the slice normal in mm, in volume order.
+
+    Read from the headers with a process pool, and cached like the volume.
+    """
+    if cacheDir is not None:
+        manifest = seriesManifest(inDirname)
+        entryDir = cacheEntryDir(inDirname, cacheDir) + '-positions'
+        volumes = loadCachedVolumes(entryDir, manifest, ['positions'])
+        if volumes is not None:
+            return np.asarray(volumes[0])
+
+    paths = _dicomPaths(inDirname)
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        headers = _sortedDicomHeaders(paths, pool,
+                                      max(1, len(paths) // (workers * 4)))
+    positions = np.array([_slicePosition(header) for header in headers])
+
+    if cacheDir is not None:
+        storeCachedVolumes(entryDir, manifest, ['positions'],
+                           lambda paths: _saveNpy(paths['positions'], positions))
+    return positions
+
+
+# ------------- Percent Image  ---------------------------------------------------
+def percentSliceCount(inDirname_image_np='./assets/image_np/') -> int:
+    return len([
+        f for f in os.listdir(inDirname_image_np)
+        if f.startswith('img_') and f.endswith('.npy')
+    ])
+
+
+def ctSlice(img) -> np.array:
+    return ((img + 1) / 2.0) * (3000 - AIR) + AIR
+
+
+def iterPercentSlices(inDirname_image_np='./assets/image_np/',
+                      inDirname_percent_np='./assets/percent_np/'):
+    """Yield (img, ct, percent) for every slice, in slice order."""
+    for i in range(percentSliceCount(inDirname_image_np)):
+        img = np.load(inDirname_image_np + f'img_{i}.npy')
+        img = img.reshape(img.shape[-2], img.shape[-1])
+
+        ct = ctSlice(img)
+
+        percent = np.load(inDirname_percent_np + f'percent_{i}.npy').reshape(
+            3, img.shape[-2], img.shape[-1])
+
+        yield img, ct, percent
+
+
+PERCENT_STACKS = ('imgs', 'solids', 'CTs', 'customdatas')
+
+
+def _fillPercentStacks(inDirname_image_np, inDirname_percent_np, allocate):
+    nslices = percentSliceCount(inDirname_image_np)
+
+    imgs_np = None
+    solids_np = None
+    CTs_np = None
+    customdatas = None
+
+    # The stacks are allocated once from the first slice and filled in place
+    for i, (img, ct, percent) in enumerate(
+            iterPercentSlices(inDirname_image_np, inDirname_percent_np)):
+        if imgs_np is None:
+            shape = (nslices, ) + img.shape
+            imgs_np = allocate('imgs', shape, img.dtype)
+            solids_np = allocate('solids', shape, percent.dtype)
+            CTs_np = allocate('CTs', shape, ct.dtype)
+            customdatas = allocate('customdatas', (nslices, 4) + img.shape,
+                                   np.result_type(ct, percent))
+
+        imgs_np[i] = img
+        solids_np[i] = percent[0]
+        CTs_np[i] = ct
+
+        # customdata
+        customdatas[i, 0] = ct
+        customdatas[i, 1:] = percent
+
+    return imgs_np, solids_np, CTs_np, customdatas
+
+
+def PercentImage(
+    inDirname_image_np='./assets/image_np/',
+    inDirname_percent_np='./assets/percent_np/'
+) -> (np.array, np.array, np.array, np.array):
+    return _fillPercentStacks(inDirname_image_np, inDirname_percent_np,
+                              lambda name, shape, dtype: np.empty(shape, dtype))
+
+
+# Stored stacks of PercentVolumes, the three percent channels quantized
+COMPACT_STACKS = ('imgs', 'solids', 'percent1', 'percent2')
+
+PERCENT_DTYPE = np.uint16
+
+
+def quantize(fraction, dtype=PERCENT_DTYPE) -> np.array:
+    """Fractions as integer codes of dtype, 0 to 1 over its whole range.
+    Values outside 0 to 1 are clipped.
+    """
+    top = np.iinfo(dtype).max
+    return np.rint(np.clip(fraction, 0.0, 1.0) * top).astype(dtype)
+
+
+def PercentVolumes(inDirname_image_np='./assets/image_np/',
+                   inDirname_percent_np='./assets/percent_np/',
+                   cacheDir=CACHE_DIR,
+                   maxSlices=HOT_SLICES,
+                   percentDtype=PERCENT_DTYPE) -> (np.array, np.array,
+                                                   np.array, np.array):
+    """PercentImage stacks, streamed into cacheDir once in a compact form.
+
+    The images keep their dtype and the percent channels are stored as
+    percentDtype codes (see quantize), as LazyVolumes with a scale. The
+    CT and customdata stacks are DerivedVolumes computed per slice.
+    """
+    images = seriesManifest(inDirname_image_np)
+    percents = seriesManifest(inDirname_percent_np)
+    manifest = {
+        "series": [images["series"], percents["series"]],
+        "files": [images["files"], percents["files"]],
+        "quantized": np.dtype(percentDtype).name,
+    }
+    entryDir = cacheEntryDir(inDirname_image_np, cacheDir)
+    scale = 1.0 / np.iinfo(percentDtype).max
+
+    volumes = loadCachedVolumes(entryDir, manifest, COMPACT_STACKS, maxSlices)
+    if volumes is None:
+
+        def write(paths):
+            nslices = percentSliceCount(inDirname_image_np)
+            stacks = None
+            for i, (img, _, percent) in enumerate(
+                    iterPercentSlices(inDirname_image_np,
+                                      inDirname_percent_np)):
+                if stacks is None:
+                    shape = (nslices, ) + img.shape
+                    stacks = [
+                        np.lib.format.open_memmap(
+                            paths[name], 'w+',
+                            img.dtype if name == 'imgs' else percentDtype,
+                            shape) for name in COMPACT_STACKS
+                    ]
+                stacks[0][i] = img
+                for stack, channel in zip(stacks[1:], percent):
+                    stack[i] = quantize(channel, percentDtype)
+            for stack in stacks:
+                stack.flush()
+
+        volumes = storeCachedVolumes(entryDir, manifest, COMPACT_STACKS,
+                                     write, maxSlices,
+                                     {name: scale
+                                      for name in COMPACT_STACKS[1:]})
+
+    imgs_np, solids_np, percent1, percent2 = volumes
+    CTs_np = DerivedVolume(imgs_np.shape, np.float64,
+                           lambda i, key: ctSlice(imgs_np[(i, ) + key]))
+
+    def customdata(i, key):
+        # key is (channel, rows, cols); only the channels and pixels asked
+        # for are read
+        channel, pixels = (key[0], key[1:]) if key else (slice(None), ())
+        at = (i, ) + pixels
+
+        def read(c):
+            if c == 0:
+                return ctSlice(imgs_np[at])
+            stack = (solids_np, percent1, percent2)[c - 1]
+            return dequantize(stack[at], stack)
+
+        channels = range(4)[channel]
+        if isinstance(channels, int):
+            return read(channels)
+        return np.stack([read(c) for c in channels])
+
+    customdatas = DerivedVolume(
+        (len(imgs_np), 4) + imgs_np.shape[1:], np.float64, customdata)
+    return imgs_np, solids_np, CTs_np, customdatas
+
+
+# ------------- Porosity  ---------------------------------------------------
+def porosityCacheDir(workbook='./assets/porosity.xlsx') -> str:
+    """Sheets of a workbook are cached as .npy record files next to it."""
+    return os.path.splitext(workbook)[0] + '.sheets'
+
+
+# Bumped when the layout of the record files changes
+RECORDS_VERSION = 2
+
+# Fields stored next to a text column: which of its cells hold text, and
+# the numbers of a column mixing text and numbers
+TEXT_VALID = '#valid'
+TEXT_NUMBER = '#number'
+
+
+def _workbookManifest(workbook):
+    st = os.stat(workbook)
+    return {
+        "workbook": os.path.abspath(workbook),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "records": RECORDS_VERSION,
+    }
+
+
+def _readWorkbookCache(workbook) -> dict:
+    manifest = _workbookManifest(workbook)
+    try:
+        with open(os.path.join(porosityCacheDir(workbook),
+                               'manifest.json')) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    if any(cached.get(k) != v for k, v in manifest.items()):
+        return dict(manifest, sheets={})
+    return cached
+
+
+def _isNumber(value) -> bool:
+    return isinstance(value, (int, float, np.number)) and not isinstance(
+        value, (bool, np.bool_))
+
+
+def _sheetRecords(df) -> np.ndarray:
+    """A sheet as a record array. Missing text cells and the numbers of
+    mixed columns are kept in TEXT_VALID and TEXT_NUMBER fields.
+    """
+    arrays, names = [], []
+    for name, col in df.items():
+        name = str(name)
+        if not (pd.api.types.is_numeric_dtype(col)
+                or pd.api.types.is_datetime64_any_dtype(col)):
+            # Text columns that only hold numbers are stored as numbers
+            numeric = pd.to_numeric(col, errors='coerce')
+            if numeric.notna().sum() == col.notna().sum():
+                col = numeric
+            else:
+                numbers = col.map(_isNumber).to_numpy(dtype=bool)
+                text = col.notna().to_numpy() & ~numbers
+                arrays.append(
+                    np.where(text, col.astype(str), '').astype(str))
+                arrays.append(text)
+                names += [name, name + TEXT_VALID]
+                if numbers.any():
+                    arrays.append(
+                        np.where(numbers, col.where(numbers),
+                                 np.nan).astype(np.float64))
+                    names.append(name + TEXT_NUMBER)
+                continue
+        arrays.append(col.to_numpy())
+        names.append(name)
+    return np.rec.fromarrays(arrays, names=names)
+
+
+def _sheetFrame(records) -> pd.DataFrame:
+    """The sheet _sheetRecords stored, text cells restored to NaN or to
+    their numbers.
+    """
+    columns = {}
+    fields = records.dtype.names
+    for name in fields:
+        if name.endswith((TEXT_VALID, TEXT_NUMBER)):
+            continue
+        values = records[name]
+        if name + TEXT_VALID in fields:
+            col = pd.Series(values, dtype=object)
+            col[~records[name + TEXT_VALID]] = np.nan
+            if name + TEXT_NUMBER in fields:
+                numbers = records[name + TEXT_NUMBER]
+                isNumber = ~np.isnan(numbers)
+                col[isNumber] = [
+                    int(v) if v.is_integer() else float(v)
+                    for v in numbers[isNumber]
+                ]
+            values = col
+        columns[name] = values
+    return pd.DataFrame(columns)
+
+
+def ingestPorosity(workbook='./assets/porosity.xlsx', sheets=None) -> list:
+    """Parse the given sheets (default all) in one pass and cache them.
+
+    Returns the names of the cached sheets.
+    """
+    frames = pd.read_excel(workbook,
+                           sheet_name=None if sheets is None else list(sheets))
+
+    cacheDir = porosityCacheDir(workbook)
+    os.makedirs(cacheDir, exist_ok=True)
+    manifest = _readWorkbookCache(workbook)
+
+    for sheet, df in frames.items():
+        fname = hashlib.sha1(sheet.encode()).hexdigest()[:12] + '.npy'
+        records = _sheetRecords(df)
+        _writeAtomic(os.path.join(cacheDir, fname),
+                     lambda path: _saveNpy(path, records))
+        manifest["sheets"][sheet] = fname
+
+    _writeAtomic(os.path.join(cacheDir, 'manifest.json'),
+                 lambda path: _saveJson(path, manifest))
+
+    return list(frames)
+
+
+def PorosityTable(workbook='./assets/porosity.xlsx',
+                  sheet='MSCL_BH-3_15m',
+                  usecols=None) -> pd.DataFrame:
+    """A workbook sheet, read from its .npy cache unless the workbook changed."""
+    fname = _readWorkbookCache(workbook)["sheets"].get(sheet)
+    if fname is None:
+        ingestPorosity(workbook, [sheet])
+        fname = _readWorkbookCache(workbook)["sheets"][sheet]
+
+    df = _sheetFrame(np.load(os.path.join(porosityCacheDir(workbook), fname)))
+    if usecols is not None:
+        # Same column order as pd.read_excel(usecols=...)
+        df = df[[col for col in df.columns if col in usecols]]
+    return df
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Pre-ingest porosity workbook sheets into the cache.")
+    parser.add_argument('workbook', nargs='?', default='./assets/porosity.xlsx')
+    parser.add_argument('sheets',
+                        nargs='*',
+                        help="sheets to ingest, all sheets by default")
+    args = parser.parse_args()
+
+    for sheet in ingestPorosity(args.workbook, args.sheets or None):
+        print(f"cached {sheet}")
@@ -0,0 +1,150 @@
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+
+import flask
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+
+log = logging.getLogger('metrics')
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of one labelled series."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Latency and response size of every Dash callback, by callback.
+
+    The slicers fetch their slices through callbacks too, so slice
+    requests show up here as upload_requested_slice and upload_thumbnails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self._bytes = defaultdict(lambda: Histogram(BYTES_BUCKETS))
+        self._errors = defaultdict(int)
+        self._values = []
+
+    def addValue(self, name, help, read, kind='gauge'):
+        """Also export a single value, read() is called on every scrape."""
+        self._values.append((name, help, kind, read))
+
+    def observe(self, labels, seconds, nbytes, status=200):
+        with self._lock:
+            self._latency[labels].observe(seconds)
+            self._bytes[labels].observe(nbytes)
+            if status >= 400:
+                self._errors[labels] += 1
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = []
+            _renderHistogram(lines, 'dash_callback_duration_seconds',
+                             'Time spent serving a Dash callback.',
+                             self._latency)
+            _renderHistogram(lines, 'dash_callback_response_bytes',
+                             'Size of a Dash callback response.', self._bytes)
+            lines += [
+                '# HELP dash_callback_errors_total Callbacks that failed.',
+                '# TYPE dash_callback_errors_total counter',
+            ]
+            for labels, count in sorted(self._errors.items()):
+                lines.append(
+                    f'dash_callback_errors_total{_labelText(labels)} {count}')
+            for name, help, kind, read in self._values:
+                lines += [
+                    f'# HELP {name} {help}', f'# TYPE {name} {kind}',
+                    f'{name} {read()}'
+                ]
+        return '\n'.join(lines) + '\n'
+
+
+def _labelText(labels, **extra) -> str:
+    pairs = [*labels, *extra.items()]
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _renderHistogram(lines, name, help, series):
+    lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for labels, hist in sorted(series.items()):
+        for bound, count in zip(hist.buckets, hist.counts):
+            lines.append(f'{name}_bucket{_labelText(labels, le=bound)} {count}')
+        lines.append(
+            f'{name}_bucket{_labelText(labels, le="+Inf")} {hist.count}')
+        lines.append(f'{name}_sum{_labelText(labels)} {hist.sum}')
+        lines.append(f'{name}_count{_labelText(labels)} {hist.count}')
+
+
+# ------------- Flask hooks  ---------------------------------------------------
+def instrument(app, metrics=None, logRequests=False, localOnly=True):
+    """Time every callback request of a Dash app and serve the results on
+    /metrics. With logRequests, each request is also logged as a JSON line.
+    """
+    metrics = Metrics() if metrics is None else metrics
+    server = app.server
+    update = app.config.requests_pathname_prefix + '_dash-update-component'
+
+    @server.before_request
+    def start_timer():
+        if flask.request.path == update:
+            flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        start = flask.g.pop('metrics_start', None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+
+        output = (flask.request.get_json(silent=True) or {}).get('output', '')
+        callback = app.callback_map.get(output, {}).get('callback')
+        name = getattr(callback, '__name__', 'unknown')
+        labels = (('callback', name), ('output', output.split('@')[0]))
+        nbytes = 0 if response.direct_passthrough else len(
+            response.get_data())
+
+        metrics.observe(labels, seconds, nbytes, response.status_code)
+        if logRequests:
+            log.info(
+                json.dumps({
+                    "callback": name,
+                    "output": labels[1][1],
+                    "seconds": round(seconds, 6),
+                    "bytes": nbytes,
+                    "status": response.status_code,
+                }))
+        return response
+
+    @server.route('/metrics')
+    def metrics_text():
+        if localOnly and flask.request.remote_addr not in ('127.0.0.1', '::1'):
+            flask.abort(403)
+        return flask.Response(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,133 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from components import labelComponents
+from loaders import cachedBeside
+from volume import volumeFile
+
+# Solid fraction at or below which a voxel is pore
+PORE_SOLID = 0.5
+
+# Slices per depth window
+PORE_WINDOW = 16
+
+# Pore sizes are binned by powers of two voxels: 1, 2-3, 4-7, ... and the
+# last bin takes everything larger
+SIZE_BINS = 16
+
+PORE_COUNT = 'Pore count per window'
+PORE_SIZE = 'Mean pore size (voxels)'
+PORE_SURFACE = 'Pore specific surface (1/voxel)'
+PORE_CONNECTED = 'Connected pore fraction'
+# Series of the report shown on the porosity chart
+PORE_COLUMNS = [PORE_COUNT, PORE_SIZE, PORE_SURFACE, PORE_CONNECTED]
+
+SIZE_COLUMNS = [
+    f'pores {2**k}-{2**(k + 1) - 1}' for k in range(SIZE_BINS - 1)
+] + [f'pores {2**(SIZE_BINS - 1)}+']
+
+REPORT_COLUMNS = ['start', 'stop', 'porosity'] + PORE_COLUMNS + SIZE_COLUMNS
+
+
+def windowStats(labelPath, sizePath, start, stop) -> list:
+    """Pore statistics of slices [start, stop) of the pore labels stored
+    at labelPath by labelComponents, the .npy at sizePath holding the size
+    of every pore, as a row of REPORT_COLUMNS.
+
+    A pore counts, with its whole size, in every window it has voxels in.
+    The specific surface is the number of pore/solid voxel faces per
+    voxel, those with the next slice included, and the connected fraction
+    the share of the window's pore voxels in pores on both its first and
+    last slice.
+    """
+    labels = np.load(labelPath, mmap_mode='r')
+    block = np.asarray(labels[start:min(stop + 1, len(labels))])
+    pores = block != 0
+    window = block[:stop - start]
+    ids, counts = np.unique(window[window != 0], return_counts=True)
+    voxels = int(counts.sum())
+
+    faces = int(np.count_nonzero(np.diff(pores, axis=0))) + sum(
+        int(np.count_nonzero(np.diff(pores[:stop - start], axis=axis)))
+        for axis in (1, 2))
+    spanning = np.isin(ids, np.intersect1d(window[0], window[-1]))
+    poreSizes = np.load(sizePath, mmap_mode='r')[ids - 1]
+    bins = np.minimum(np.log2(poreSizes).astype(int), SIZE_BINS - 1)
+
+    return [
+        start,
+        stop,
+        voxels / window.size,
+        len(ids),
+        poreSizes.mean() if len(ids) else np.nan,
+        faces / window.size,
+        counts[spanning].sum() / voxels if voxels else np.nan,
+        *np.bincount(bins, minlength=SIZE_BINS),
+    ]
+
+
+def _report(volume, window, poreSolid, connectivity, workers) -> pd.DataFrame:
+    """Label the pores of the whole volume once, then sum them up window
+    by window in parallel.
+    """
+    n = len(volume)
+    source = volumeFile(volume)
+    # The labels are as large as the volume, keep them on its disk
+    with tempfile.TemporaryDirectory(
+            dir=source and os.path.dirname(source)) as tmpDir:
+        labelPath = os.path.join(tmpDir, 'labels.npy')
+        sizePath = os.path.join(tmpDir, 'sizes.npy')
+        pores = labelComponents(volume,
+                                vmax=poreSolid,
+                                connectivity=connectivity,
+                                labelPath=labelPath,
+                                workers=workers)
+        # Saved once for the workers rather than sent with every window
+        np.save(sizePath, pores['size'].to_numpy())
+        with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+            jobs = [
+                pool.submit(windowStats, labelPath, sizePath, s,
+                            min(s + window, n)) for s in range(0, n, window)
+            ]
+            rows = [job.result() for job in jobs]
+    return pd.DataFrame(rows, columns=REPORT_COLUMNS)
+
+
+def PoreReport(solids,
+               window=PORE_WINDOW,
+               poreSolid=PORE_SOLID,
+               connectivity=1,
+               workers=None) -> pd.DataFrame:
+    """Pore statistics of every window of window slices of a solid-fraction
+    stack, one row per window (see windowStats). Pores are labelled over
+    the whole stack with labelComponents, so a pore crossing windows stays
+    one pore.
+
+    The report of a memory-mapped stack is stored next to its file, one
+    .npy per column, and rebuilt when the file changes.
+    """
+    names = [f'c{i}' for i in range(len(REPORT_COLUMNS))]
+    manifest = {
+        "window": window,
+        "pore solid": poreSolid,
+        "connectivity": connectivity,
+        "labelling": 'stack',
+        "columns": REPORT_COLUMNS,
+    }
+
+    def write(paths):
+        report = _report(solids, window, poreSolid, connectivity, workers)
+        for name, column in zip(names, REPORT_COLUMNS):
+            with open(paths[name], 'wb') as f:
+                np.save(f, report[column].to_numpy())
+
+    columns = cachedBeside(solids, '-pores', manifest, names, write, 0)
+    if columns is None:
+        return _report(solids, window, poreSolid, connectivity, workers)
+    return pd.DataFrame(
+        {c: np.asarray(v)
+         for c, v in zip(REPORT_COLUMNS, columns)})
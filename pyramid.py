@@ -0,0 +1,150 @@
+import numpy as np
+
+from analysis import iterBlocks
+from loaders import cachedBeside
+from volume import HOT_SLICES
+
+# Decimation factor of every pyramid level
+DECIMATION = (4, )
+
+
+def decimate(block, factor) -> np.ndarray:
+    """Mean of every factor x factor cell of each slice in block.
+
+    Slices that do not divide evenly are padded by repeating their last
+    row and column, so the level is ceil(size / factor) pixels wide.
+    """
+    if factor == 1:
+        return np.asarray(block)
+    n, h, w = block.shape
+    height, width = -(-h // factor), -(-w // factor)
+    cells = np.pad(np.asarray(block, dtype=np.float32),
+                   ((0, 0), (0, height * factor - h),
+                    (0, width * factor - w)),
+                   mode='edge').reshape(n, height, factor, width, factor)
+    level = cells.mean(axis=(2, 4))
+    if np.issubdtype(block.dtype, np.integer):
+        level = np.rint(level)
+    return level.astype(block.dtype)
+
+
+def levelShape(shape, factor) -> tuple:
+    n, h, w = shape
+    return n, -(-h // factor), -(-w // factor)
+
+
+def Pyramid(volume, factors=DECIMATION, maxSlices=HOT_SLICES) -> dict:
+    """Decimated copies of every slice of a volume, by decimation factor.
+
+    The levels of a memory-mapped volume are stored next to its file and
+    rebuilt when the file changes; those of an in-memory volume are
+    computed in memory.
+    """
+    names = [f'x{factor}' for factor in factors]
+
+    def write(paths):
+        for factor, name in zip(factors, names):
+            level = np.lib.format.open_memmap(paths[name], 'w+', volume.dtype,
+                                              levelShape(volume.shape, factor))
+            for start, block in iterBlocks(volume):
+                level[start:start + len(block)] = decimate(block, factor)
+            level.flush()
+
+    levels = cachedBeside(volume, '-pyramid', {"factors": list(factors)},
+                          names, write, maxSlices)
+    if levels is None:
+        return {
+            factor: np.concatenate(
+                [decimate(block, factor) for _, block in iterBlocks(volume)])
+            for factor in factors
+        }
+    return dict(zip(factors, levels))
+
+
+# ------------- Tiles  ---------------------------------------------------
+TILE = 256
+
+# Decimation factor of every tiled level, 1 is the full slice
+TILE_FACTORS = (1, 2, 4, 8)
+
+# Screen pixels a slicer graph is assumed to be wide. Slices larger than
+# this are served as tiles, from the level closest to it.
+VIEW_PIXELS = 512
+
+
+def tileBlock(block, tile=TILE) -> np.ndarray:
+    """Every slice of block cut into tile x tile tiles, as an array of
+    (slices, rows, cols, tile, tile). Edge tiles repeat the last pixels.
+    """
+    n, h, w = block.shape
+    rows, cols = -(-h // tile), -(-w // tile)
+    padded = np.pad(np.asarray(block),
+                    ((0, 0), (0, rows * tile - h), (0, cols * tile - w)),
+                    mode='edge')
+    return padded.reshape(n, rows, tile, cols, tile).transpose(0, 1, 3, 2, 4)
+
+
+class TiledLevel:
+    """One pyramid level stored tile by tile, so reading a tile is one
+    contiguous read whatever the size of the slice.
+    """
+
+    def __init__(self, tiles, factor, shape):
+        self.tiles = tiles
+        self.factor = factor
+        self.shape = shape
+        self.tile = tiles.shape[-1]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """The (index, row, col) tile without the edge padding."""
+        index, row, col = key
+        _, h, w = self.shape
+        tile = self.tiles[index, row, col]
+        return tile[:h - row * self.tile, :w - col * self.tile]
+
+    def cover(self, y0, y1, x0, x1) -> list:
+        """(row, col) of the tiles covering a range of level pixels."""
+        _, h, w = self.shape
+        rows = range(max(int(y0) // self.tile, 0),
+                     min(-(-int(np.ceil(y1)) // self.tile), -(-h // self.tile)))
+        cols = range(max(int(x0) // self.tile, 0),
+                     min(-(-int(np.ceil(x1)) // self.tile), -(-w // self.tile)))
+        return [(row, col) for row in rows for col in cols]
+
+
+def TiledPyramid(volume, factors=TILE_FACTORS, tile=TILE,
+                 maxSlices=HOT_SLICES) -> dict:
+    """Tiled levels of a volume's slices, by decimation factor.
+
+    Like Pyramid, the levels of a memory-mapped volume are stored once
+    next to its file, those of an in-memory volume are kept in memory.
+    """
+    shapes = {factor: levelShape(volume.shape, factor) for factor in factors}
+    names = [f't{factor}' for factor in factors]
+
+    def write(paths):
+        for factor, name in zip(factors, names):
+            n, h, w = shapes[factor]
+            tiles = np.lib.format.open_memmap(
+                paths[name], 'w+', volume.dtype,
+                (n, -(-h // tile), -(-w // tile), tile, tile))
+            for start, block in iterBlocks(volume):
+                tiles[start:start + len(block)] = tileBlock(
+                    decimate(block, factor), tile)
+            tiles.flush()
+
+    levels = cachedBeside(volume, '-tiles', {
+        "factors": list(factors),
+        "tile": tile
+    }, names, write, maxSlices)
+    if levels is None:
+        levels = [
+            np.concatenate([
+                tileBlock(decimate(block, factor), tile)
+                for _, block in iterBlocks(volume)
+            ]) for factor in factors
+        ]
+    return {
+        factor: TiledLevel(level, factor, shapes[factor])
+        for factor, level in zip(factors, levels)
+    }
@@ -0,0 +1,271 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from analysis import AI_POROSITY, SlicePorosity, addSliceColumns
+from figures import DepthIndex, frameVersion
+from histograms import HistogramIndex, Histograms
+from loaders import (DicomImage, DicomSlicePositions, PercentVolumes,
+                     PorosityTable, seriesManifest)
+from pores import PORE_COLUMNS, PoreReport
+from pyramid import VIEW_PIXELS, Pyramid, TiledPyramid
+from roi import SummedAreaTable, SummedAreas
+from volume import LazyVolume, mappedBase
+
+MAX_BYTES = 2 * 1024**3
+
+
+def sizeOf(value) -> int:
+    """Resident bytes of a loaded value.
+
+    Memory-mapped arrays, and plain views of them, live in the page cache
+    and count as nothing except the hot slices a LazyVolume currently holds.
+    """
+    if isinstance(value, LazyVolume):
+        return value.hotBytes
+    if isinstance(value, np.ndarray):
+        return 0 if mappedBase(value) is not None else value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sum(sizeOf(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeOf(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return sizeOf(vars(value))
+    return 0
+
+
+class DatasetSpec:
+    """Where the files of one core live."""
+
+    def __init__(self,
+                 name,
+                 dicomDir,
+                 imageDir,
+                 percentDir,
+                 workbook,
+                 sheet,
+                 usecols=None,
+                 rows=None,
+                 depthCol='Depth (cm)'):
+        self.name = name
+        self.dicomDir = dicomDir
+        self.imageDir = imageDir
+        self.percentDir = percentDir
+        self.workbook = workbook
+        self.sheet = sheet
+        self.usecols = usecols
+        self.rows = rows
+        self.depthCol = depthCol
+
+    @classmethod
+    def fromDir(cls, root, usecols=None):
+        """A core directory with RockCT/, image_np/, percent_np/ and a
+        dataset.json naming the workbook and sheet, e.g.
+        {"workbook": "porosity.xlsx", "sheet": "MSCL_BH-3_15m"}.
+        """
+        with open(os.path.join(root, 'dataset.json')) as f:
+            info = json.load(f)
+        return cls(info.get('name', os.path.basename(os.path.normpath(root))),
+                   os.path.join(root, info.get('dicom', 'RockCT')),
+                   os.path.join(root, info.get('image_np', 'image_np'), ''),
+                   os.path.join(root, info.get('percent_np', 'percent_np'),
+                                ''),
+                   os.path.join(root, info['workbook']),
+                   info['sheet'],
+                   usecols=usecols,
+                   rows=info.get('rows'),
+                   depthCol=info.get('depth', 'Depth (cm)'))
+
+    def version(self) -> list:
+        """Files of the core with their sizes and modification times, which
+        change whenever any of them is rewritten.
+        """
+        stat = os.stat(self.workbook)
+        return [
+            seriesManifest(self.dicomDir),
+            seriesManifest(self.imageDir),
+            seriesManifest(self.percentDir),
+            [os.path.abspath(self.workbook), stat.st_size, stat.st_mtime_ns],
+        ]
+
+
+class Dataset:
+    """A loaded core: CT volume, percent stacks and porosity table.
+
+    The indexes behind the slicers and region statistics are built on
+    first use, so a core only shown on the porosity chart never needs
+    them.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.Hu = DicomImage(spec.dicomDir)
+        self.imgs_np, self.solids_np, self.CTs_np, self.customdatas = \
+            PercentVolumes(spec.imageDir, spec.percentDir)
+
+        df = PorosityTable(spec.workbook, spec.sheet, usecols=spec.usecols)
+        if spec.rows is not None:
+            df = df.iloc[:spec.rows]
+
+        # Depth of every CT slice, the first slice at the top of the logged core
+        self.depth_index = DepthIndex.fromPositions(
+            DicomSlicePositions(spec.dicomDir),
+            depth0=df[spec.depthCol].min())
+
+        # Porosity computed from the AI percent maps, one value per slice
+        self.slice_porosity = SlicePorosity(
+            self.solids_np).iloc[:len(self.depth_index)]
+        self.df = addSliceColumns(
+            df, spec.depthCol,
+            self.depth_index.depths[:len(self.slice_porosity)],
+            {AI_POROSITY: self.slice_porosity["porosity"].to_numpy()})
+
+        # Pore statistics of every depth window, at the window's mean depth
+        report = PoreReport(self.solids_np)
+        self.pore_report = report[report["stop"] <= len(self.depth_index)]
+        depths = [
+            self.depth_index.depths[start:stop].mean() for start, stop in zip(
+                self.pore_report["start"], self.pore_report["stop"])
+        ]
+        self.df = addSliceColumns(
+            self.df, spec.depthCol, depths,
+            {c: self.pore_report[c].to_numpy() for c in PORE_COLUMNS})
+        self.df_version = frameVersion(self.df)
+
+    # Decimated slices, shown while the slicer sliders move
+    @cached_property
+    def Hu_levels(self) -> dict:
+        return Pyramid(self.Hu)
+
+    @cached_property
+    def solids_levels(self) -> dict:
+        return Pyramid(self.solids_np)
+
+    # Slices too large to send whole are served as viewport tiles
+    @property
+    def large(self) -> bool:
+        return max(self.Hu.shape[1:]) > VIEW_PIXELS
+
+    @cached_property
+    def Hu_tiles(self):
+        return TiledPyramid(self.Hu) if self.large else None
+
+    @cached_property
+    def solids_tiles(self):
+        return TiledPyramid(self.solids_np) if self.large else None
+
+    # HU histograms of every slice and tile, for slab histograms
+    @cached_property
+    def Hu_histograms(self) -> HistogramIndex:
+        return Histograms(self.Hu)
+
+    # Summed-area tables, for the mean HU and porosity of drawn boxes
+    @cached_property
+    def Hu_sums(self) -> SummedAreaTable:
+        return SummedAreas(self.Hu)
+
+    @cached_property
+    def solids_sums(self) -> SummedAreaTable:
+        return SummedAreas(self.solids_np)
+
+    @property
+    def nbytes(self) -> int:
+        return sizeOf({k: v for k, v in vars(self).items() if k != 'spec'})
+
+
+class DatasetRegistry:
+    """Known cores, loaded on first use and kept in an LRU bounded by
+    maxBytes of resident data. Pinned cores are never evicted.
+    """
+
+    def __init__(self, maxBytes=MAX_BYTES, load=Dataset):
+        self.maxBytes = maxBytes
+        self._load = load
+        self._specs = OrderedDict()
+        self._loaded = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def register(self, spec):
+        self._specs[spec.name] = spec
+
+    def discover(self, root, usecols=None) -> list:
+        """Register every core directory under root that has a dataset.json."""
+        found = []
+        if not os.path.isdir(root):
+            return found
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isfile(os.path.join(path, 'dataset.json')):
+                spec = DatasetSpec.fromDir(path, usecols)
+                self.register(spec)
+                found.append(spec.name)
+        return found
+
+    def names(self) -> list:
+        return list(self._specs)
+
+    def spec(self, name) -> DatasetSpec:
+        return self._specs[name]
+
+    def isLoaded(self, name) -> bool:
+        with self._lock:
+            return name in self._loaded
+
+    def pin(self, name):
+        self._pinned.add(name)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(dataset.nbytes for dataset in list(self._loaded.values()))
+
+    def get(self, name):
+        with self._lock:
+            dataset = self._loaded.get(name)
+            if dataset is not None:
+                self._loaded.move_to_end(name)
+                # Hot slices grow after loading, so re-check the budget
+                self._evict(keep=name)
+                return dataset
+            spec = self._specs[name]
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        # One thread loads a core, others asking for it wait for the result
+        with loading:
+            with self._lock:
+                dataset = self._loaded.get(name)
+            if dataset is None:
+                dataset = self._load(spec)
+                with self._lock:
+                    self._loaded[name] = dataset
+                    self._evict(keep=name)
+
+        return dataset
+
+    def _evict(self, keep):
+        for name in list(self._loaded):
+            if self.nbytes <= self.maxBytes:
+                break
+            if name == keep or name in self._pinned:
+                continue
+            del self._loaded[name]
+
+
+# ------------- Jobs  ---------------------------------------------------
+
+
+def ingestDataset(progress, spec) -> str:
+    """JobQueue job: load a core once, from the fields of its DatasetSpec,
+    so that all its caches are on disk and loading it again is quick.
+    """
+    progress(0.0, f'loading {spec["name"]}')
+    Dataset(DatasetSpec(**spec))
+    return spec["name"]
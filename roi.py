@@ -0,0 +1,244 @@
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from skimage import draw
+
+from analysis import blockStep, iterBlocks
+from histograms import binIndices
+from loaders import cachedBeside
+from volume import dequantize
+
+
+class SummedAreaTable:
+    """Sums of a volume over any box of slices, rows and columns.
+
+    Entry [k, y, x] of the table is the sum of the volume over slices
+    below k, rows below y and columns below x, so the sum over a box is
+    eight lookups whatever its size. scale turns the sums of a quantized
+    volume back into its units.
+    """
+
+    def __init__(self, table, scale=None):
+        # A plain view, the corners are read with one fancy index
+        self.table = np.asarray(table)
+        self.scale = scale
+
+    @property
+    def shape(self) -> tuple:
+        n, h, w = self.table.shape
+        return n - 1, h - 1, w - 1
+
+    def clip(self, start, stop, y0, y1, x0, x1) -> tuple:
+        """The box clipped to the volume, as (start, stop, y0, y1, x0, x1)."""
+        n, h, w = self.shape
+        start, stop = min(max(start, 0), n), min(max(stop, 0), n)
+        y0, y1 = min(max(y0, 0), h), min(max(y1, 0), h)
+        x0, x1 = min(max(x0, 0), w), min(max(x1, 0), w)
+        return start, max(start, stop), y0, max(y0, y1), x0, max(x0, x1)
+
+    def count(self, start, stop, y0, y1, x0, x1) -> int:
+        start, stop, y0, y1, x0, x1 = self.clip(start, stop, y0, y1, x0, x1)
+        return (stop - start) * (y1 - y0) * (x1 - x0)
+
+    def sum(self, start, stop, y0, y1, x0, x1) -> float:
+        """Sum over slices [start, stop), rows [y0, y1), columns [x0, x1)."""
+        start, stop, y0, y1, x0, x1 = self.clip(start, stop, y0, y1, x0, x1)
+        corners = self.table[np.ix_((start, stop), (y0, y1), (x0, x1))]
+        for _ in range(3):
+            corners = corners[1] - corners[0]
+        total = corners.item()
+        return total if self.scale is None else total * self.scale
+
+    def mean(self, start, stop, y0, y1, x0, x1) -> float:
+        count = self.count(start, stop, y0, y1, x0, x1)
+        if count == 0:
+            return float('nan')
+        return self.sum(start, stop, y0, y1, x0, x1) / count
+
+
+def _sumDtype(dtype):
+    return np.int64 if np.issubdtype(dtype, np.integer) else np.float64
+
+
+def _fillTable(volume, table):
+    """Write the summed-area table of volume into table, a block at a time."""
+    n, h, w = volume.shape
+    table[0] = 0
+    table[:, 0, :] = 0
+    table[:, :, 0] = 0
+    for start, block in iterBlocks(volume, blockStep(h * w)):
+        planes = np.cumsum(np.cumsum(block, axis=1, dtype=table.dtype),
+                           axis=2)
+        np.cumsum(planes, axis=0, out=planes)
+        planes += table[start, 1:, 1:]
+        table[start + 1:start + 1 + len(block), 1:, 1:] = planes
+
+
+def SummedAreas(volume) -> SummedAreaTable:
+    """SummedAreaTable of a volume.
+
+    The table of a memory-mapped volume is stored next to its file and
+    rebuilt when the file changes. Sums of a quantized volume are kept
+    as exact integer sums of its codes.
+    """
+    n, h, w = volume.shape
+    dtype = _sumDtype(volume.dtype)
+    scale = getattr(volume, 'scale', None)
+
+    def write(paths):
+        table = np.lib.format.open_memmap(paths['table'], 'w+', dtype,
+                                          (n + 1, h + 1, w + 1))
+        _fillTable(volume, table)
+        table.flush()
+
+    tables = cachedBeside(volume, '-sat', {}, ['table'], write, 0)
+    if tables is None:
+        table = np.empty((n + 1, h + 1, w + 1), dtype)
+        _fillTable(volume, table)
+        return SummedAreaTable(table, scale)
+    return SummedAreaTable(tables[0], scale)
+
+
+# ------------- Polygons  ---------------------------------------------------
+# Masks kept by MaskCache
+MASK_ENTRIES = 64
+
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def pathVertices(path) -> np.ndarray:
+    """Vertices of a closed SVG path of straight lines ("M x,y L x,y ... Z"),
+    as an array of (x, y) points.
+    """
+    return np.array(_NUMBER.findall(path), dtype=float).reshape(-1, 2)
+
+
+class RegionMask:
+    """The pixels of a drawn shape, as a boolean mask of its bounding box
+    [y0, y1) x [x0, x1) within the slice.
+    """
+
+    def __init__(self, mask, y0, x0):
+        self.mask = mask
+        self.y0, self.x0 = y0, x0
+
+    @property
+    def box(self) -> (int, int, int, int):
+        h, w = self.mask.shape
+        return self.y0, self.y0 + h, self.x0, self.x0 + w
+
+    @property
+    def count(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def select(self, block) -> np.ndarray:
+        """Pixels of every slice of a bounding-box block, as (slices, pixels)."""
+        return np.asarray(block)[:, self.mask]
+
+
+def rectPixels(shape) -> (int, int, int, int):
+    """Pixel rows and columns [y0, y1) x [x0, x1) under a rect shape."""
+    y0, y1 = sorted([shape["y0"], shape["y1"]])
+    x0, x1 = sorted([shape["x0"], shape["x1"]])
+    # Pixel centres are at integer coordinates
+    return (int(np.floor(y0 + 0.5)), int(np.ceil(y1 + 0.5)),
+            int(np.floor(x0 + 0.5)), int(np.ceil(x1 + 0.5)))
+
+
+def shapeMask(shape, sliceShape) -> RegionMask:
+    """RegionMask of a plotly rect or closed path shape on slices of
+    sliceShape. Only the bounding box of a path is rasterized, a pixel
+    being in when its centre is.
+    """
+    h, w = sliceShape
+    if shape.get("type") == "path":
+        x, y = pathVertices(shape["path"]).T
+        y0, y1 = int(np.ceil(y.min())), int(np.floor(y.max())) + 1
+        x0, x1 = int(np.ceil(x.min())), int(np.floor(x.max())) + 1
+    else:
+        y0, y1, x0, x1 = rectPixels(shape)
+    y0, x0 = min(max(y0, 0), h), min(max(x0, 0), w)
+    y1, x1 = min(max(y1, y0), h), min(max(x1, x0), w)
+
+    if shape.get("type") == "path":
+        mask = np.zeros((y1 - y0, x1 - x0), bool)
+        rr, cc = draw.polygon(y - y0, x - x0, mask.shape)
+        mask[rr, cc] = True
+    else:
+        mask = np.ones((y1 - y0, x1 - x0), bool)
+    return RegionMask(mask, y0, x0)
+
+
+def shapeGeometry(shape) -> dict:
+    """A drawn shape without its styling."""
+    return {
+        k: shape[k]
+        for k in ("type", "path", "x0", "x1", "y0", "y1") if k in shape
+    }
+
+
+def shapeKey(shape, sliceShape) -> str:
+    """Hash of the geometry of a drawn shape on slices of sliceShape."""
+    text = json.dumps([shapeGeometry(shape), list(sliceShape)],
+                      sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class MaskCache:
+    """The RegionMasks of the last maxEntries shapes, by shape hash."""
+
+    def __init__(self, maxEntries=MASK_ENTRIES):
+        self.maxEntries = maxEntries
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, shape, sliceShape) -> RegionMask:
+        key = shapeKey(shape, sliceShape)
+        with self._lock:
+            region = self._masks.get(key)
+            if region is not None:
+                self._masks.move_to_end(key)
+                return region
+
+        region = shapeMask(shape, sliceShape)
+        with self._lock:
+            self._masks[key] = region
+            while len(self._masks) > self.maxEntries:
+                self._masks.popitem(last=False)
+        return region
+
+
+def regionStats(volume, region, start=0, stop=None, edges=None) -> dict:
+    """Voxel count, sum and mean of volume inside region over the slices
+    start to stop - 1, and its histogram over edges when given.
+
+    Only the bounding box of the region is read, a block of slices at a
+    time, so no temporary is larger than BLOCK_VALUES values.
+    """
+    start, stop, _ = slice(start, stop).indices(len(volume))
+    y0, y1, x0, x1 = region.box
+    count = 0
+    total = 0.0
+    counts = None if edges is None else np.zeros(len(edges) - 1, np.int64)
+    step = blockStep(region.mask.size)
+    for k in range(start, stop, step):
+        block = volume[k:min(k + step, stop), y0:y1, x0:x1]
+        values = dequantize(region.select(block), volume)
+        count += values.size
+        total += float(values.sum(dtype=np.float64))
+        if counts is not None:
+            counts += np.bincount(binIndices(values, edges).ravel(),
+                                  minlength=len(counts))
+    return {
+        "count": count,
+        "sum": total,
+        "mean": total / count if count else float('nan'),
+        "histogram": counts,
+    }
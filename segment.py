@@ -0,0 +1,102 @@
+import os
+import tempfile
+
+import numpy as np
+from scipy import ndimage
+from skimage import measure
+
+from analysis import blockStep
+from components import labelComponents
+from roi import shapeMask
+
+# Median filter footprints, (slices, rows, cols), of the values before
+# thresholding and of the mask before its surface is extracted
+MEDIAN_SIZE = (1, 3, 3)
+SURFACE_MEDIAN_SIZE = (1, 7, 7)
+
+# Marching cubes step, in voxels
+SURFACE_STEP = 3
+
+
+def openVolume(volume) -> np.ndarray:
+    """volume itself, or the .npy file it names memory-mapped."""
+    if isinstance(volume, str):
+        return np.load(volume, mmap_mode='r')
+    return volume
+
+
+def largestComponent(mask) -> np.ndarray:
+    """The largest connected part of a mask, labelled with labelComponents."""
+    with tempfile.TemporaryDirectory() as tmpDir:
+        labelPath = os.path.join(tmpDir, 'labels.npy')
+        components = labelComponents(mask, labelPath=labelPath)
+        if components.empty:
+            return mask
+        return np.load(labelPath) == components['size'].idxmax()
+
+
+# ------------- Jobs  ---------------------------------------------------
+# Run by a JobQueue, so each takes a progress callback first
+
+
+def segmentRegion(progress, volume, shape, start, stop, vmin, vmax) -> dict:
+    """Voxels of the slices start to stop - 1 inside a drawn shape whose
+    median-filtered value is in (vmin, vmax], largest connected part only.
+
+    Returns the box [start, stop, y0, y1, x0, x1] the mask covers and the
+    mask itself; only the box (and a pixel around it) is read.
+    """
+    volume = openVolume(volume)
+    n, h, w = volume.shape
+    region = shapeMask(shape, (h, w))
+    y0, y1, x0, x1 = region.box
+    start, stop, _ = slice(start, stop).indices(n)
+    stop = max(start, stop)
+
+    # A margin so the filter sees the same neighbours as on the whole slice
+    my0, my1 = max(y0 - 1, 0), min(y1 + 1, h)
+    mx0, mx1 = max(x0 - 1, 0), min(x1 + 1, w)
+    inner = (slice(None), slice(y0 - my0, y1 - my0), slice(x0 - mx0, x1 - mx0))
+
+    mask = np.zeros((stop - start, y1 - y0, x1 - x0), bool)
+    step = blockStep((my1 - my0) * (mx1 - mx0))
+    for k in range(start, stop, step):
+        progress(0.8 * (k - start) / (stop - start), 'filtering')
+        block = np.asarray(volume[k:min(k + step, stop), my0:my1, mx0:mx1])
+        values = ndimage.median_filter(block, size=MEDIAN_SIZE)[inner]
+        mask[k - start:k - start + len(block)] = ((values > vmin) &
+                                                  (values <= vmax) &
+                                                  region.mask)
+
+    progress(0.8, 'labelling')
+    return {
+        "box": [start, stop, y0, y1, x0, x1],
+        "mask": largestComponent(mask),
+    }
+
+
+def surfaceMesh(progress, mask, box, step=SURFACE_STEP) -> dict:
+    """Triangles of the surface of a segmentRegion mask, as the x (column),
+    y (row), z (slice) and i, j, k arguments of a plotly Mesh3d.
+    """
+    progress(0.0, 'smoothing')
+    # Padded so surfaces touching the box are closed
+    smooth = np.pad(
+        ndimage.median_filter(np.asarray(mask, np.uint8),
+                              size=SURFACE_MEDIAN_SIZE), 1)
+    if not smooth.any():
+        return {key: [] for key in "xyzijk"}
+
+    progress(0.5, 'marching cubes')
+    verts, faces, _, _ = measure.marching_cubes(smooth, 0.5, step_size=step)
+    verts += np.array([box[0], box[2], box[4]]) - 1
+    z, y, x = verts.T
+    k, j, i = faces.T
+    return {
+        "x": x.tolist(),
+        "y": y.tolist(),
+        "z": z.tolist(),
+        "i": i.tolist(),
+        "j": j.tolist(),
+        "k": k.tolist(),
+    }
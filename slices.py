@@ -0,0 +1,583 @@
+import os
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+
+import dash
+from dash import dcc
+from dash.dependencies import Input, Output, State
+from dash_slicer import VolumeSlicer
+from dash_slicer.utils import img_array_to_uri
+
+from pyramid import VIEW_PIXELS
+from volume import volumeVersion
+
+SLICE_BYTES = 256 * 1024**2
+
+PREFETCH_SLICES = 8
+
+# RGBA of segmentation overlays
+OVERLAY_COLOR = (255, 0, 0, 100)
+
+
+def toUint8(im, clim) -> np.ndarray:
+    """Scale an image to uint8 between the contrast limits, like
+    VolumeSlicer._slice.
+    """
+    im = np.asarray(im, dtype=np.float32)
+    clim = min(clim), max(clim)
+    im = (im - clim[0]) * (255 / (clim[1] - clim[0]))
+    return np.clip(im, 0, 255).astype(np.uint8)
+
+
+class SliceCache:
+    """Encoded slice images in an LRU bounded by maxBytes.
+
+    With diskDir, every encoded slice is also written there, so other
+    processes and later runs read it instead of encoding it again.
+    """
+
+    def __init__(self, maxBytes=SLICE_BYTES, diskDir=None):
+        self.maxBytes = maxBytes
+        self.diskDir = diskDir
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._uris = OrderedDict()
+        self._lock = threading.Lock()
+        if diskDir is not None:
+            os.makedirs(diskDir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._uris)
+
+    def __contains__(self, key):
+        return key in self._uris
+
+    def get(self, key, encode) -> str:
+        with self._lock:
+            uri = self._uris.get(key)
+            if uri is not None:
+                self._uris.move_to_end(key)
+                self.hits += 1
+                return uri
+
+        uri = self._readDisk(key)
+        if uri is not None:
+            with self._lock:
+                self.diskHits += 1
+        else:
+            uri = encode()
+            self._writeDisk(key, uri)
+            with self._lock:
+                self.misses += 1
+
+        self.put(key, uri)
+        return uri
+
+    def put(self, key, uri):
+        with self._lock:
+            old = self._uris.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._uris[key] = uri
+            self.nbytes += len(uri)
+            while self.nbytes > self.maxBytes and len(self._uris) > 1:
+                _, evicted = self._uris.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def _diskPath(self, key) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.diskDir, digest[:2], digest + '.uri')
+
+    def _readDisk(self, key):
+        if self.diskDir is None:
+            return None
+        try:
+            with open(self._diskPath(key)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _writeDisk(self, key, uri):
+        if self.diskDir is None:
+            return
+        path = self._diskPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique temp name, several workers may encode the same slice at once
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(uri)
+        os.replace(tmp, path)
+
+
+class SlicePrefetcher:
+    """Encodes the slices ahead of the one being viewed into the slice
+    cache in background threads.
+
+    The scroll direction comes from the index the same browser session
+    requested before, which the slicer keeps in that session's store.
+    After a jump, or before there is a direction, slices on both sides
+    are encoded. Queued slices of the session that fall out of the new
+    window are cancelled; other sessions' queues are left alone. For a
+    tiled slicer, view is the (xrange, yrange) on screen and the tiles
+    covering it are encoded instead of whole slices.
+    """
+
+    def __init__(self, count=PREFETCH_SLICES, workers=2):
+        self.count = count
+        self.scheduled = 0
+        self.cancelled = 0
+        self._pool = ThreadPoolExecutor(workers,
+                                        thread_name_prefix='prefetch')
+        # Cancelling a future runs its done callback, which takes the lock too
+        self._lock = threading.RLock()
+        # Queued futures by (slicer, session) and slice key
+        self._pending = {}
+
+    def targets(self, index, last, nslices) -> list:
+        """Slice indices to encode after index, nearest first."""
+        step = None if last is None else index - last
+        if step is None or step == 0 or abs(step) > self.count:
+            offsets = [d * s for d in range(1, self.count // 2 + 1)
+                       for s in (1, -1)]
+        else:
+            offsets = [d if step > 0 else -d for d in range(1, self.count + 1)]
+        return [index + d for d in offsets if 0 <= index + d < nslices]
+
+    def schedule(self, slicer, index, clim, view=None, last=None,
+                 session=None):
+        """Queue the slices around index for a session whose previous
+        index was last.
+        """
+        clim = float(min(clim)), float(max(clim))
+        with self._lock:
+            wanted = self.targets(index, last, slicer.nslices)
+
+            pending = self._pending.setdefault((slicer, session), {})
+            for key in list(pending):
+                if key[0] not in wanted or key[1:] != (clim, view):
+                    if pending.pop(key).cancel():
+                        self.cancelled += 1
+
+            for i in wanted:
+                key = (i, clim, view)
+                if key in pending or slicer.isCached(i, clim, view):
+                    continue
+                future = self._pool.submit(slicer.warm, i, clim, view)
+                future.add_done_callback(lambda f, key=key: self._done(
+                    (slicer, session), key, f))
+                pending[key] = future
+                self.scheduled += 1
+
+    def cancel(self, slicer, session=None):
+        """Drop the queued slices of one session of a slicer."""
+        with self._lock:
+            for future in self._pending.pop((slicer, session), {}).values():
+                if future.cancel():
+                    self.cancelled += 1
+
+    def join(self, slicer, index, clim):
+        """Wait for a slice that is being encoded already, so it is not
+        encoded twice. A slice still in the queue is cancelled instead.
+        """
+        clim = float(min(clim)), float(max(clim))
+        key = (index, clim, None)
+        with self._lock:
+            futures = [
+                pending[key] for owner, pending in self._pending.items()
+                if owner[0] is slicer and key in pending
+            ]
+        for future in futures:
+            if not future.cancel():
+                future.result()
+
+    def _done(self, owner, key, future):
+        with self._lock:
+            pending = self._pending.get(owner, {})
+            if pending.get(key) is future:
+                del pending[key]
+            if not pending:
+                # Sessions come and go, drop their empty queues
+                self._pending.pop(owner, None)
+
+
+class CachedSlicer(VolumeSlicer):
+    """A VolumeSlicer whose slice and thumbnail images go through a
+    SliceCache, keyed by dataset, axis, index, clim and resolution.
+
+    With a prefetcher, the slices next to each requested one are encoded
+    in the background. With levels, a dict of decimated copies of the
+    volume by factor (see pyramid.py), every slider position is first
+    shown from the preview level, and the full slice is only sent once
+    the slider settles.
+
+    With tiles, a dict of TiledLevels by factor, slices are not sent
+    whole: only the tiles covering the viewport are sent, from the
+    coarsest level that still has viewPixels across it.
+    """
+
+    def __init__(self,
+                 app,
+                 volume,
+                 *,
+                 dataset,
+                 cache,
+                 prefetcher=None,
+                 levels=None,
+                 preview=None,
+                 tiles=None,
+                 viewPixels=VIEW_PIXELS,
+                 **kwargs):
+        self._dataset = dataset
+        self._cache = cache
+        self._prefetcher = prefetcher
+        self._levels = levels or {}
+        if preview is None and self._levels:
+            preview = max(self._levels)
+        self._previewFactor = preview
+        self._tiles = tiles or {}
+        self._viewPixels = viewPixels
+        if (self._levels or self._tiles) and kwargs.get('axis', 0) != 0:
+            raise ValueError("Pyramid levels are only supported on axis 0.")
+        self._version = volumeVersion(volume)
+        super().__init__(app, volume, **kwargs)
+
+    def sliceKey(self, index, clim, resolution=None) -> tuple:
+        clim = float(min(clim)), float(max(clim))
+        return (self._dataset, self._version, self._axis, int(index), clim,
+                resolution)
+
+    def isCached(self, index, clim, view=None) -> bool:
+        """Whether the full slice, or every tile of view, is cached."""
+        if view is None:
+            return self.sliceKey(index, clim) in self._cache
+        factor, cover = self.viewCover(*view)
+        return all(
+            self.sliceKey(index, clim, ('tile', factor, row, col)) in
+            self._cache for row, col in cover)
+
+    def warm(self, index, clim, view=None):
+        """Encode the full slice, or the tiles of view, into the cache."""
+        if view is None:
+            self.sliceUri(index, clim, join=False)
+        else:
+            self.viewTiles(index, clim, *view)
+
+    def sliceUri(self, index, clim, resolution=None, join=True) -> str:
+        """The slice as a PNG data URI, resolution None for full size or
+        the thumbnail size.
+        """
+        key = self.sliceKey(index, clim, resolution)
+        if join and resolution is None and self._prefetcher is not None:
+            self._prefetcher.join(self, index, clim)
+        return self._cache.get(
+            key, lambda: img_array_to_uri(self._slice(index, clim), resolution))
+
+    def thumbnailUri(self, index, clim) -> str:
+        """The thumbnail of a slice. With pyramid levels it is made from
+        the coarsest one, so thumbnails never read full slices.
+        """
+        resolution = self._thumbnail_param
+        if resolution is None or not self._levels:
+            return self.sliceUri(index, clim, resolution, join=False)
+        level = self._levels[max(self._levels)]
+
+        def build():
+            im = PIL.Image.fromarray(toUint8(level[index], clim))
+            # Exactly the size the client stretches thumbnails from
+            size = tuple(self._slice_info["thumbnail_size"])
+            return img_array_to_uri(np.asarray(im.resize(size)))
+
+        return self._cache.get(self.sliceKey(index, clim, resolution), build)
+
+    def levelUri(self, index, clim, factor) -> str:
+        key = self.sliceKey(index, clim, f'x{factor}')
+        return self._cache.get(
+            key, lambda: img_array_to_uri(
+                toUint8(self._levels[factor][index], clim)))
+
+    def viewCover(self, xrange, yrange) -> (int, list):
+        """The tiled level to show a viewport from and the (row, col) of
+        the tiles covering it. The ranges are in scene coordinates.
+        """
+        info = self._slice_info
+        x0, x1 = ((x - info["offset"][0]) / info["stepsize"][0]
+                  for x in sorted(xrange))
+        y0, y1 = ((y - info["offset"][1]) / info["stepsize"][1]
+                  for y in sorted(yrange))
+        span = max(x1 - x0, y1 - y0)
+        fits = [f for f in self._tiles if span / f >= self._viewPixels]
+        factor = max(fits) if fits else min(self._tiles)
+        # Pixel centres are at integer positions, so pixel i spans i +- 0.5
+        cover = self._tiles[factor].cover((y0 + 0.5) / factor,
+                                          (y1 + 0.5) / factor,
+                                          (x0 + 0.5) / factor,
+                                          (x1 + 0.5) / factor)
+        return factor, cover
+
+    def viewTiles(self, index, clim, xrange, yrange) -> list:
+        """Image traces of the tiles covering a viewport."""
+        info = self._slice_info
+        factor, cover = self.viewCover(xrange, yrange)
+        level = self._tiles[factor]
+        dx = info["stepsize"][0] * factor
+        dy = info["stepsize"][1] * factor
+        traces = []
+        for row, col in cover:
+            key = self.sliceKey(index, clim, ('tile', factor, row, col))
+            source = self._cache.get(
+                key, lambda: img_array_to_uri(
+                    toUint8(level[index, row, col], clim)))
+            traces.append({
+                "source": source,
+                # The centre of the tile's first pixel, in scene coordinates
+                "x0": info["offset"][0] + (col * level.tile + 0.5) * dx -
+                0.5 * info["stepsize"][0],
+                "y0": info["offset"][1] + (row * level.tile + 0.5) * dy -
+                0.5 * info["stepsize"][1],
+                "dx": dx,
+                "dy": dy,
+            })
+        return traces
+
+    def boxOverlayData(self, mask, box, color=OVERLAY_COLOR) -> list:
+        """Output for overlay_data of a mask covering box [start, stop, y0,
+        y1, x0, x1]; only the slices the box covers are encoded.
+        """
+        start, stop, y0, y1, x0, x1 = box
+        overlays = [None] * self.nslices
+        rgba = np.zeros(self._volume.shape[1:] + (4, ), np.uint8)
+        for index in range(start, stop):
+            im = mask[index - start]
+            if not im.any():
+                continue
+            rgba[:] = 0
+            rgba[y0:y1, x0:x1][im] = color
+            overlays[index] = img_array_to_uri(rgba)
+        return overlays
+
+    def _create_dash_components(self):
+        super()._create_dash_components()
+        # The coarse slice shown while the slider moves
+        self._preview = dcc.Store(id=self._subid("preview"), data=None)
+        self._stores.append(self._preview)
+        # The tiles covering the viewport, for a tiled slicer
+        self._view_tiles = dcc.Store(id=self._subid("view-tiles"), data=None)
+        self._stores.append(self._view_tiles)
+        # This browser session's id and last index, for the prefetcher
+        self._session = dcc.Store(id=self._subid("session"), data=None)
+        self._stores.append(self._session)
+
+    def _prefetch(self, session, index, clim, view=None):
+        """Queue the slices around index for a browser session, and return
+        the session's new state.
+        """
+        if self._prefetcher is None:
+            return dash.no_update
+        session = dict(session or {"id": uuid.uuid4().hex})
+        self._prefetcher.schedule(self, index, clim, view,
+                                  session.get("index"), session["id"])
+        session["index"] = index
+        return session
+
+    def _create_server_callbacks(self):
+        app = self._app
+
+        @app.callback(
+            Output(self._thumbs_data.id, "data"),
+            [Input(self._clim.id, "data")],
+        )
+        def upload_thumbnails(clim):
+            return [self.thumbnailUri(i, clim) for i in range(self.nslices)]
+
+        if self._tiles:
+
+            @app.callback(
+                Output(self._view_tiles.id, "data"),
+                Output(self._session.id, "data"),
+                [Input(self._state.id, "data"),
+                 Input(self._clim.id, "data")],
+                [State(self._session.id, "data")],
+            )
+            def upload_view_tiles(state, clim, session):
+                if state is None:
+                    return dash.no_update, dash.no_update
+                index = state["index"]
+                view = tuple(state["xrange"]), tuple(state["yrange"])
+                tiles = self.viewTiles(index, clim, *view)
+                return ({"index": index, "tiles": tiles},
+                        self._prefetch(session, index, clim, view))
+
+        elif self._thumbnail_param is not None:
+
+            @app.callback(
+                Output(self._server_data.id, "data"),
+                Output(self._session.id, "data"),
+                [Input(self._state.id, "data"),
+                 Input(self._clim.id, "data")],
+                [State(self._session.id, "data")],
+            )
+            def upload_requested_slice(state, clim, session):
+                if state is None or not state["index_changed"]:
+                    return dash.no_update, dash.no_update
+                index = state["index"]
+                slice = self.sliceUri(index, clim)
+                return ({"index": index, "slice": slice},
+                        self._prefetch(session, index, clim))
+
+        if self._previewFactor is not None:
+
+            @app.callback(
+                Output(self._preview.id, "data"),
+                [Input(self._slider.id, "value")],
+                [State(self._clim.id, "data")],
+                prevent_initial_call=True,
+            )
+            def upload_preview(index, clim):
+                if index is None:
+                    return dash.no_update
+                level = self._levels[self._previewFactor]
+                return {
+                    "index": index,
+                    "slice": self.levelUri(index, clim, self._previewFactor),
+                    "size": [level.shape[2], level.shape[1]],
+                }
+
+    def _create_client_callbacks(self):
+        if self._tiles:
+            self._createBaseCallbacks(skip=Output(self._img_traces.id, "data"))
+            self._create_tile_callback()
+        else:
+            super()._create_client_callbacks()
+        if self._previewFactor is None:
+            return
+
+        # Show the preview in place of the thumbnail, unless the full
+        # slice has arrived already
+        self._app.clientside_callback(
+            """
+        function show_preview(preview, index, server_data, view_tiles, overlays, info) {
+            if (!preview || preview.index != index || server_data.index == index) {
+                return dash_clientside.no_update;
+            }
+            if (view_tiles && view_tiles.index == index) {
+                return dash_clientside.no_update;
+            }
+            let slice_trace = {
+                type: 'image',
+                x0: info.offset[0],
+                y0: info.offset[1],
+                dx: info.stepsize[0],
+                dy: info.stepsize[1],
+                hovertemplate: '(%{x:.2f}, %{y:.2f})<extra></extra>'
+            };
+            let overlay_trace = {...slice_trace};
+            overlay_trace.hoverinfo = 'skip';
+            overlay_trace.source = overlays[index] || '';
+            overlay_trace.hovertemplate = '';
+
+            // Stretch the coarse image over the area of the full slice
+            slice_trace.source = preview.slice;
+            slice_trace.dx *= info.size[0] / preview.size[0];
+            slice_trace.dy *= info.size[1] / preview.size[1];
+            slice_trace.x0 += 0.5 * slice_trace.dx - 0.5 * info.stepsize[0];
+            slice_trace.y0 += 0.5 * slice_trace.dy - 0.5 * info.stepsize[1];
+            return [slice_trace, overlay_trace];
+        }
+        """,
+            Output(self._img_traces.id, "data", allow_duplicate=True),
+            [Input(self._preview.id, "data")],
+            [
+                State(self._slider.id, "value"),
+                State(self._server_data.id, "data"),
+                State(self._view_tiles.id, "data"),
+                State(self._overlay_data.id, "data"),
+                State(self._info.id, "data"),
+            ],
+            prevent_initial_call=True,
+        )
+
+    def _createBaseCallbacks(self, skip):
+        """dash_slicer's client callbacks, but for the one writing skip.
+
+        In tile mode its image trace callback would draw the stretched
+        thumbnail over the tiles whenever the overlays or thumbnails
+        change, as the whole slice never arrives in server_data.
+        """
+        app = self._app
+        register = app.clientside_callback
+
+        def clientside_callback(code, output, *args, **kwargs):
+            if str(output) == str(skip) and not output.allow_duplicate:
+                return
+            register(code, output, *args, **kwargs)
+
+        app.clientside_callback = clientside_callback
+        try:
+            super()._create_client_callbacks()
+        finally:
+            del app.clientside_callback
+
+    def _create_tile_callback(self):
+        # Draw the tiles as one image trace each, under the overlay, or
+        # the thumbnail until the tiles of the slice arrive
+        self._app.clientside_callback(
+            """
+        function show_view_tiles(view_tiles, index, overlays, thumbnails, info) {
+            let traces = [];
+            if (view_tiles && view_tiles.index == index) {
+                for (let tile of view_tiles.tiles) {
+                    traces.push({
+                        type: 'image',
+                        source: tile.source,
+                        x0: tile.x0,
+                        y0: tile.y0,
+                        dx: tile.dx,
+                        dy: tile.dy,
+                        hovertemplate: '(%{x:.2f}, %{y:.2f})<extra></extra>'
+                    });
+                }
+            } else {
+                let dx = info.stepsize[0] * info.size[0] / info.thumbnail_size[0];
+                let dy = info.stepsize[1] * info.size[1] / info.thumbnail_size[1];
+                traces.push({
+                    type: 'image',
+                    source: (thumbnails || [])[index] || '',
+                    x0: info.offset[0] + 0.5 * dx - 0.5 * info.stepsize[0],
+                    y0: info.offset[1] + 0.5 * dy - 0.5 * info.stepsize[1],
+                    dx: dx,
+                    dy: dy,
+                    hovertemplate: '(%{x:.2f}, %{y:.2f})<extra></extra>'
+                });
+            }
+            traces.push({
+                type: 'image',
+                x0: info.offset[0],
+                y0: info.offset[1],
+                dx: info.stepsize[0],
+                dy: info.stepsize[1],
+                source: overlays[index] || '',
+                hoverinfo: 'skip',
+                hovertemplate: ''
+            });
+            return traces;
+        }
+        """,
+            Output(self._img_traces.id, "data"),
+            [
+                Input(self._view_tiles.id, "data"),
+                Input(self._slider.id, "value"),
+                Input(self._overlay_data.id, "data"),
+                Input(self._thumbs_data.id, "data"),
+            ],
+            [State(self._info.id, "data")],
+        )
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from components import labelComponents
+
+
+@pytest.mark.parametrize("connectivity", [1, 2, 3])
+def test_labelComponents_matches_ndimage(tmp_path, connectivity):
+    """Labels and component table of a mask labelled in blocks of 3 slices
+    match ndimage.label over the whole mask."""
+    mask = np.random.default_rng(connectivity).random((16, 20, 24)) < 0.35
+    labelPath = str(tmp_path / "labels.npy")
+    table = labelComponents(mask.astype(np.uint8),
+                            connectivity=connectivity,
+                            labelPath=labelPath,
+                            workers=2,
+                            step=3)
+
+    expected, count = ndimage.label(
+        mask, ndimage.generate_binary_structure(3, connectivity))
+    np.testing.assert_array_equal(np.load(labelPath), expected)
+
+    assert len(table) == count
+    np.testing.assert_array_equal(table['size'],
+                                  np.bincount(expected.ravel())[1:])
+    boxes = ndimage.find_objects(expected)
+    for axis, (lo, hi) in enumerate([('z0', 'z1'), ('y0', 'y1'),
+                                     ('x0', 'x1')]):
+        np.testing.assert_array_equal(table[lo],
+                                      [box[axis].start for box in boxes])
+        np.testing.assert_array_equal(table[hi],
+                                      [box[axis].stop for box in boxes])
+    np.testing.assert_allclose(
+        table[['cz', 'cy', 'cx']],
+        ndimage.center_of_mass(mask, expected, np.arange(1, count + 1)))
@@ -0,0 +1,210 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Slices each process keeps private copies of. The memory map itself is
+# shared by every process that maps the file, so HOT_SLICES=0 leaves a
+# single copy of the data per host however many workers serve it.
+HOT_SLICES = int(os.environ.get('HOT_SLICES', 64))
+
+
+def volumeRange(volume, step=64) -> (float, float):
+    """Min and max of a volume, scanned a block of slices at a time."""
+    lo, hi = np.inf, -np.inf
+    for start in range(0, len(volume), step):
+        block = np.asarray(volume[start:start + step])
+        lo = min(lo, block.min())
+        hi = max(hi, block.max())
+    return float(lo), float(hi)
+
+
+def mappedBase(volume):
+    """The memory map a volume is a view of, or None."""
+    base = volume
+    while base is not None:
+        if isinstance(base, np.memmap) and base.filename:
+            return base
+        # Unpickled arrays are based on bytes
+        base = getattr(base, 'base', None)
+    return None
+
+
+def volumeFile(volume):
+    """Path of the file a volume is memory-mapped from, or None.
+
+    Only a volume covering its whole map has one: a slab, a transpose or
+    a reversed view of a map is a different volume from the file's.
+    """
+    base = mappedBase(volume)
+    if (base is None or volume.shape != base.shape
+            or volume.strides != base.strides or volume.dtype != base.dtype
+            or volume.__array_interface__['data'][0] !=
+            base.__array_interface__['data'][0]):
+        return None
+    return base.filename
+
+
+def volumeVersion(volume) -> str:
+    """A string that changes whenever the volume's data does.
+
+    Memory-mapped volumes are identified by their file, size and mtime,
+    in-memory ones by a hash of their bytes.
+    """
+    path = volumeFile(volume)
+    if path is not None:
+        st = os.stat(path)
+        return f'{path}:{st.st_size}:{st.st_mtime_ns}'
+    digest = hashlib.sha1(np.ascontiguousarray(volume).view(np.uint8))
+    return f'{volume.shape}:{volume.dtype}:{digest.hexdigest()}'
+
+
+class LazyVolume(np.ndarray):
+    """A read-only volume that reads slices on demand from a memory-mapped
+    store, keeping the most recently used axis-0 slices in memory.
+
+    It is a real ndarray, so it can be handed to VolumeSlicer and indexed
+    like the in-memory stacks; anything but an axis-0 slice lookup reads
+    straight through the memory map. With maxSlices=0 slices are returned
+    as read-only views of the map and nothing is copied.
+    """
+
+    def __new__(cls, source, maxSlices=HOT_SLICES, clim=None, scale=None):
+        if isinstance(source, str):
+            source = np.load(source, mmap_mode='r')
+        obj = source.view(cls)
+        obj._hot = OrderedDict()
+        obj._maxSlices = maxSlices
+        obj._lock = threading.Lock()
+        obj._clim = None if clim is None else (float(clim[0]),
+                                               float(clim[1]))
+        obj._scale = scale
+        return obj
+
+    def __array_finalize__(self, obj):
+        # Views and derived arrays have their own indices, so no slice cache
+        self._hot = None
+        self._maxSlices = 0
+        self._lock = None
+        self._clim = None
+        # but views hold the same quantized codes
+        self._scale = getattr(obj, '_scale', None)
+
+    def __array_wrap__(self, arr, *args, **kwargs):
+        # Like np.memmap: results of computations are plain arrays
+        arr = arr.view(np.ndarray)
+        if arr.shape == ():
+            return arr[()]
+        return arr
+
+    @property
+    def hotBytes(self) -> int:
+        """Bytes held by the hot slices."""
+        if self._hot is None:
+            return 0
+        with self._lock:
+            return sum(hot.nbytes for hot in self._hot.values())
+
+    @property
+    def clim(self) -> (float, float):
+        if self._clim is None:
+            self._clim = volumeRange(self)
+        return self._clim
+
+    @property
+    def scale(self):
+        """Value of one step of a quantized volume's integer codes, or None
+        for a volume that stores its values.
+        """
+        return self._scale
+
+    def _sliceIndex(self, key):
+        if isinstance(key, tuple):
+            if not key or any(k != slice(None) for k in key[1:]):
+                return None
+            key = key[0]
+        if isinstance(key, (int, np.integer)) and not isinstance(key, bool):
+            index = int(key)
+            if index < 0:
+                index += self.shape[0]
+            if 0 <= index < self.shape[0]:
+                return index
+        return None
+
+    def __getitem__(self, key):
+        index = None if self._hot is None else self._sliceIndex(key)
+        if index is None:
+            return np.ndarray.__getitem__(self, key)
+        if self._maxSlices == 0:
+            view = np.ndarray.__getitem__(self, index).view(np.ndarray)
+            view.flags.writeable = False
+            return view
+
+        with self._lock:
+            hot = self._hot.get(index)
+            if hot is not None:
+                self._hot.move_to_end(index)
+                return hot
+
+        hot = np.array(np.ndarray.__getitem__(self, index).view(np.ndarray))
+        hot.flags.writeable = False
+
+        with self._lock:
+            self._hot[index] = hot
+            self._hot.move_to_end(index)
+            while len(self._hot) > self._maxSlices:
+                self._hot.popitem(last=False)
+        return hot
+
+
+def dequantize(values, volume) -> np.ndarray:
+    """Values read from volume in the units they stand for.
+
+    A quantized volume stores integer codes and a scale, anything else
+    is returned as it is.
+    """
+    scale = getattr(volume, 'scale', None)
+    if scale is None:
+        return values
+    return np.asarray(values, dtype=np.float32) * np.float32(scale)
+
+
+class DerivedVolume:
+    """A read-only volume computed slice by slice, for arrays that are
+    cheap to derive from stored ones and not worth storing.
+
+    compute(index, key) returns slice index indexed by key, a tuple of
+    indices into shape[1:] that is empty for the whole slice. Reading a
+    single value then only reads what that value is derived from.
+    """
+
+    def __init__(self, shape, dtype, compute):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._compute = compute
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        index, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key,
+                                                                        ())
+        if isinstance(index, (int, np.integer)):
+            index = range(len(self))[index]
+            return np.asarray(self._compute(index, rest), dtype=self.dtype)
+
+        indices = range(len(self))[index]
+        out = np.empty((len(indices), ) + self.shape[1:], self.dtype)
+        for i, index in enumerate(indices):
+            out[i] = self._compute(index, ())
+        return out[(slice(None), ) + rest] if rest else out
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)